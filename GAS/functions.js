@@ -15,6 +15,27 @@ SHEETS = {
   IP_HISTORY: SpreadsheetApp.openById(CONFIG.SPREADSHEET_ID).getSheetByName(CONFIG.IP_HISTORY_SHEET_NAME)
 }
 
+/** Seconds the network state and its snapshots are cached for (the maximum CacheService allows) */
+const NETWORK_CACHE_TTL = 21600;
+
+/**
+ * IP_HISTORY is only pruned once it holds this many times the rows it needs
+ * (MAX_IP_LOGS_FOR_EVERY_SERVICE for every service), so the full rewrite is amortized over many writes
+ */
+const IP_HISTORY_PRUNE_FACTOR = 2;
+
+/** Network responses shorter than this (in characters of JSON) are never compressed, gzip wouldn't make them smaller */
+const COMPRESSION_MIN_SIZE = 1024;
+
+/** Rows logged during the current request, written to the LOG sheet in one go by flushLogs() */
+const LOG_BUFFER = [];
+
+/** The network state read during the current request, see getNetworkState(). Reset by doPost() */
+let NETWORK_STATE = null;
+
+/** Set once the network state turned out too large for the cache during the current request, see saveNetworkState() */
+let NETWORK_STATE_UNCACHEABLE = false;
+
 
 
 
@@ -64,6 +85,17 @@ function doPost(e) {
    * - parse 'e.postData.contents' before trying to access the data it contains.
    */
   
+  NETWORK_STATE = null;
+  NETWORK_STATE_UNCACHEABLE = false;
+  try {
+    return handlePost(e);
+  }
+  finally {
+    flushLogs();
+  }
+}
+
+function handlePost(e) {
   try {
     logThisObject('POST received:', e);
     const contents = JSON.parse(e.postData.contents);
@@ -81,8 +113,7 @@ function doPost(e) {
     switch(contents.requestType) {
       case 'UPDATE_IP':
         appendIP(contents.serviceName, contents.ip);
-        clearExceedingLogs();
-        clearObsoleteIPs();
+        pruneIPHistoryIfNeeded();
         return createResponse(200, `Logged new ip for service ${contents.serviceName}: ${contents.ip}`, 'OK');
 
       case 'REQUEST_IP':
@@ -90,11 +121,40 @@ function doPost(e) {
         return createResponse(200, `Last known ip for service ${contents.serviceName}: ${lastIp}`, lastIp);
 
       case 'REQUEST_NETWORK':
-        const network = retrieveNetwork();
+        const network = compressNetworkResponse(buildNetworkResponse(contents.networkVersion), contents.compression);
         return createResponse(200, `Currently known network`, network);
 
+      case 'REPORT_AND_FETCH':
+        // Records the ip only if it changed, then answers with the network in the same response
+        let reportMessage = `No ip to record for service ${contents.serviceName}`;
+        if (contents.ip && contents.ip !== retrieveLastIP(contents.serviceName)) {
+          appendIP(contents.serviceName, contents.ip);
+          pruneIPHistoryIfNeeded();
+          reportMessage = `Logged new ip for service ${contents.serviceName}: ${contents.ip}`;
+        }
+        else if (contents.ip) {
+          reportMessage = `Ip unchanged for service ${contents.serviceName}`;
+        }
+        else if (contents.heartbeat) {
+          recordHeartbeat(contents.serviceName);
+          reportMessage = `Heartbeat recorded for service ${contents.serviceName}`;
+        }
+        return createResponse(200, reportMessage, compressNetworkResponse(buildNetworkResponse(contents.networkVersion), contents.compression));
+
+      case 'UPDATE_IPS':
+        // Gateway agents report many services at once: only the ips that changed are recorded, in a single write
+        const knownNetwork = getNetworkState().network;
+        const updates = (contents.updates || []).filter(([serviceName, ip]) => ip && ip !== knownNetwork[serviceName]);
+        if (updates.length > 0) {
+          appendIPs(updates);
+          pruneIPHistoryIfNeeded();
+        }
+        if (contents.heartbeat) recordHeartbeat(contents.serviceName);
+        return createResponse(200, `Logged ${updates.length} new ips from service ${contents.serviceName}`, compressNetworkResponse(buildNetworkResponse(contents.networkVersion), contents.compression));
+
       default:
         logThisNotice('ERROR', `could not understand request: ${contents.requestType}`);
+        return createResponse(400, `Unknown requestType: ${contents.requestType}`);
     }
   }
   catch (error) {
@@ -116,8 +176,19 @@ function createResponse(status, message, value = null) {
 /**
  * Returns a network: an array of [label, ip] elements. 
  * Each element is a service with its last known ip.
+ * Read from the cached network state, see getNetworkState().
  */
 function retrieveNetwork() {
+  const network = getNetworkState().network;
+  return Object.keys(network).map(label => [label, network[label]]);
+}
+
+/**
+ * Builds the network by traversing the whole IP_HISTORY table from the bottom up.
+ * Only used to rebuild the network state when it's not cached.
+ */
+function scanIPHistory() {
+  if (SHEETS.IP_HISTORY.getLastRow() < 2) return [];
   const ipHistoryTable = SHEETS.IP_HISTORY.getRange(2, 1, SHEETS.IP_HISTORY.getLastRow(), SHEETS.IP_HISTORY.getLastColumn()).getValues();
   const lastIps = {};
 
@@ -141,6 +212,151 @@ function retrieveNetwork() {
   return lastIpsArray;
 }
 
+/**
+ * Returns the network state as {version, network}, where network is a {label: ip} object
+ * and version is a hash of its content.
+ * The state is kept in the script cache so that requests don't have to scan IP_HISTORY,
+ * it's rebuilt from the sheet only when the cache has expired, and read once per request.
+ * After editing IP_HISTORY by hand, run invalidateNetworkState() to pick up the changes immediately.
+ */
+function getNetworkState() {
+  if (NETWORK_STATE) return NETWORK_STATE;
+  const cached = CacheService.getScriptCache().get('NETWORK_STATE');
+  if (cached) return NETWORK_STATE = JSON.parse(cached);
+
+  // Rebuild under the writers' lock: a scan started before a concurrent appendIP()
+  // would otherwise be saved over its update, hiding the new ip until the cache expires
+  const lock = LockService.getScriptLock();
+  lock.waitLock(10000);
+  try {
+    return readNetworkState();
+  }
+  finally {
+    lock.releaseLock();
+  }
+}
+
+/**
+ * Reads the network state from the cache, rebuilding it from IP_HISTORY if it's not there.
+ * Only call it while holding the script lock.
+ */
+function readNetworkState() {
+  // Too large to be cached: this request already scanned the sheet, don't do it again
+  if (NETWORK_STATE_UNCACHEABLE) return NETWORK_STATE;
+  const cached = CacheService.getScriptCache().get('NETWORK_STATE');
+  if (cached) return NETWORK_STATE = JSON.parse(cached);
+
+  const network = {};
+  scanIPHistory().forEach(([label, ip]) => network[label] = ip);
+  return saveNetworkState(network);
+}
+
+/**
+ * Stores the network state, along with a snapshot of this version
+ * so that clients still holding it can later be sent a delta.
+ * CacheService refuses values over 100KB: a network that large isn't cached at all,
+ * so it's rebuilt from IP_HISTORY on every request (slow, but right) and clients get it whole.
+ * @param {object} network - The {label: ip} object
+ */
+function saveNetworkState(network) {
+  const state = { version: computeNetworkVersion(network), network: network };
+  NETWORK_STATE = state;
+  if (NETWORK_STATE_UNCACHEABLE) return state;
+  const cache = CacheService.getScriptCache();
+  try {
+    cache.put('NETWORK_STATE', JSON.stringify(state), NETWORK_CACHE_TTL);
+    cache.put(`NETWORK_${state.version}`, JSON.stringify(network), NETWORK_CACHE_TTL);
+  }
+  catch (error) {
+    // Never leave an older state behind, it would be served instead of the sheet
+    cache.remove('NETWORK_STATE');
+    NETWORK_STATE_UNCACHEABLE = true;
+    logThisNotice('WARNING', `Network too large to be cached (${Object.keys(network).length} services), reading IP_HISTORY on every request: ${error}`);
+  }
+  return state;
+}
+
+/**
+ * Sets the ip of some services in the network state.
+ * @param {Array} updates - The [serviceName, ip] of every service to update
+ */
+function updateNetworkState(updates) {
+  const lock = LockService.getScriptLock();
+  lock.waitLock(10000);
+  try {
+    // Not the state read earlier in this request: another one may have written since
+    const state = readNetworkState();
+    const changed = updates.filter(([serviceName, ip]) => state.network[serviceName] !== ip);
+    if (changed.length === 0) return state;
+    changed.forEach(([serviceName, ip]) => state.network[serviceName] = ip);
+    return saveNetworkState(state.network);
+  }
+  finally {
+    lock.releaseLock();
+  }
+}
+
+function invalidateNetworkState() {
+  CacheService.getScriptCache().remove('NETWORK_STATE');
+  NETWORK_STATE = null;
+  NETWORK_STATE_UNCACHEABLE = false;
+}
+
+/**
+ * Hashes the network content, so that the same network always has the same version
+ * even after the cache has been rebuilt.
+ * @param {object} network - The {label: ip} object
+ */
+function computeNetworkVersion(network) {
+  const entries = Object.keys(network).sort().map(label => [label, network[label]]);
+  const digest = Utilities.computeDigest(Utilities.DigestAlgorithm.MD5, JSON.stringify(entries));
+  return digest.map(byte => ((byte + 256) % 256).toString(16).padStart(2, '0')).join('');
+}
+
+/**
+ * Builds the network to send to a client that knows version knownVersion of it.
+ * - knownVersion undefined (older clients): the whole network as an array of [label, ip]
+ * - knownVersion is current: {version, unchanged: true}
+ * - knownVersion still cached: {version, added, changed, removed}
+ * - otherwise: {version, network}
+ * @param {string} knownVersion - The version the client last received
+ */
+function buildNetworkResponse(knownVersion) {
+  const state = getNetworkState();
+  const toArray = network => Object.keys(network).map(label => [label, network[label]]);
+
+  if (knownVersion === undefined) return toArray(state.network);
+  if (knownVersion === state.version) return { version: state.version, unchanged: true };
+
+  const knownSnapshot = knownVersion ? CacheService.getScriptCache().get(`NETWORK_${knownVersion}`) : null;
+  if (!knownSnapshot) return { version: state.version, network: toArray(state.network) };
+
+  const knownNetwork = JSON.parse(knownSnapshot);
+  const delta = { version: state.version, added: [], changed: [], removed: [] };
+  for (let label in state.network) {
+    if (!(label in knownNetwork)) delta.added.push([label, state.network[label]]);
+    else if (knownNetwork[label] !== state.network[label]) delta.changed.push([label, state.network[label]]);
+  }
+  for (let label in knownNetwork) {
+    if (!(label in state.network)) delta.removed.push(label);
+  }
+  return delta;
+}
+
+/**
+ * Gzips a network response for the clients that asked for it with compression: 'gzip'.
+ * Clients that don't ask (older ones) always get it as is.
+ * @param {Array|object} value - The network response, see buildNetworkResponse()
+ * @param {string} compression - The compression the client asked for
+ */
+function compressNetworkResponse(value, compression) {
+  if (compression !== 'gzip') return value;
+  const json = JSON.stringify(value);
+  if (json.length < COMPRESSION_MIN_SIZE) return value;
+  const compressed = Utilities.gzip(Utilities.newBlob(json, 'application/json'));
+  return { compressed: 'gzip', data: Utilities.base64Encode(compressed.getBytes()) };
+}
+
 /**
  * We're not using this at this time, but GAS requires
  * doGet(e) to be there for deploying the script as webapp
@@ -150,19 +366,23 @@ function doGet(e) {
 }
 
 /**
- * Traverses the table from the bottom up and finds the last known ip 
- * for the requested service.
+ * Returns the last known ip for the requested service, or null if it never logged one.
+ * Read from the cached network state, see getNetworkState().
  * 
  *  @param {string} serviceName - The name of the service
  */
 function retrieveLastIP(serviceName) {
-  // 1. Get the entire table as 2d array - this is faster than checking every row with single calls
-  // 2. Filter the result to only the rows with the serviceName we want
-  // 3. Since .filter() preserves order, the record we want is the last item of the filtered array, so we can just .pop() it
-  const ip = SHEETS.IP_HISTORY.getRange(2, 1, SHEETS.IP_HISTORY.getLastRow(), SHEETS.IP_HISTORY.getLastColumn()).getValues()
-  .filter(row => row[CONFIG.COLUMNS.SERVICE_NAME - 1] === serviceName).pop()[CONFIG.COLUMNS.SERVICE_IP - 1];
+  const ip = getNetworkState().network[serviceName];
+  return ip === undefined ? null : ip;
+}
 
-  return ip;
+/**
+ * Stores the time serviceName was last seen, without touching the sheets.
+ * Script properties are much cheaper than a row append.
+ *  @param {string} serviceName - The service
+ */
+function recordHeartbeat(serviceName) {
+  PropertiesService.getScriptProperties().setProperty(`HEARTBEAT_${serviceName}`, String(Date.now()));
 }
 
 /**
@@ -173,9 +393,22 @@ function retrieveLastIP(serviceName) {
 function appendIP(serviceName, ip) {
   const newRow = [Date.now(), serviceName, ip];
   SHEETS.IP_HISTORY.appendRow(newRow);
+  updateNetworkState([[serviceName, ip]]);
   logThisNotice('IP UPDATED', `New IP ${ip} logged for service ${serviceName}`);
 }
 
+/**
+ * Logs many new ips at once, with a single write to IP_HISTORY
+ * @param {Array} updates - The [serviceName, ip] of every service to log
+ */
+function appendIPs(updates) {
+  const now = Date.now();
+  const newRows = updates.map(([serviceName, ip]) => [now, serviceName, ip]);
+  SHEETS.IP_HISTORY.getRange(SHEETS.IP_HISTORY.getLastRow() + 1, 1, newRows.length, newRows[0].length).setValues(newRows);
+  updateNetworkState(updates);
+  updates.forEach(([serviceName, ip]) => logThisNotice('IP UPDATED', `New IP ${ip} logged for service ${serviceName}`));
+}
+
 /**
  * For every service, deletes the oldest IPs exceeding the maximum number
  * allowed for storage.
@@ -192,7 +425,6 @@ function clearObsoleteIPs() {
   const newIpHistoryTable = []
   for (let i = ipHistoryTable.length - 1; i >= 0; i--) {
     const currentLabel = ipHistoryTable[i][CONFIG.COLUMNS.SERVICE_NAME - 1];
-    Logger.log(seenLabels[currentLabel])
     if (seenLabels[currentLabel]) {
       // Skip if already gotten to max IP to store
       if (seenLabels[currentLabel] >= CONFIG.MAX_IP_LOGS_FOR_EVERY_SERVICE) continue;
@@ -202,18 +434,63 @@ function clearObsoleteIPs() {
     newIpHistoryTable.push(ipHistoryTable[i]);
   }
 
-  clearIPHistory();
+  // The latest ip of every service is kept, so the network state stays valid. The lock keeps
+  // getNetworkState() from rebuilding it out of the sheet while it's empty
+  const lock = LockService.getScriptLock();
+  lock.waitLock(10000);
+  try {
+    deleteIPHistoryRows();
 
-  // Add back the filtered results
-  newIpHistoryTable.reverse()
+    // Add back the filtered results
+    newIpHistoryTable.reverse()
 
-  if (newIpHistoryTable.length > 0) {
-    SHEETS.IP_HISTORY.getRange(2, 1, newIpHistoryTable.length, newIpHistoryTable[0].length).setValues(newIpHistoryTable);
+    if (newIpHistoryTable.length > 0) {
+      SHEETS.IP_HISTORY.getRange(2, 1, newIpHistoryTable.length, newIpHistoryTable[0].length).setValues(newIpHistoryTable);
+    }
+  }
+  finally {
+    lock.releaseLock();
   }
 
   logThisNotice('clearObsoleteIPs', 'Cleared obsolete IPs')
 }
 
+/**
+ * Runs clearObsoleteIPs() only when IP_HISTORY has grown well past what it needs to keep,
+ * instead of rewriting the whole sheet on every write.
+ */
+function pruneIPHistoryIfNeeded() {
+  const serviceCount = Object.keys(getNetworkState().network).length;
+  const threshold = Math.max(1, serviceCount) * CONFIG.MAX_IP_LOGS_FOR_EVERY_SERVICE * IP_HISTORY_PRUNE_FACTOR;
+  if (SHEETS.IP_HISTORY.getLastRow() - 1 > threshold) {
+    clearObsoleteIPs();
+  }
+}
+
+/**
+ * Time-driven trigger: prunes IP_HISTORY and LOG regardless of thresholds.
+ * Install it once with installMaintenanceTrigger().
+ */
+function runMaintenance() {
+  try {
+    clearObsoleteIPs();
+    clearExceedingLogs();
+  }
+  finally {
+    flushLogs();
+  }
+}
+
+/**
+ * Run this once from the editor to prune the sheets every night.
+ */
+function installMaintenanceTrigger() {
+  ScriptApp.getProjectTriggers()
+    .filter(trigger => trigger.getHandlerFunction() === 'runMaintenance')
+    .forEach(trigger => ScriptApp.deleteTrigger(trigger));
+  ScriptApp.newTrigger('runMaintenance').timeBased().everyDays(1).atHour(3).create();
+}
+
 /**
  * Deletes old logs when they are more than CONFIG.MAX_LOGS
  */
@@ -237,9 +514,14 @@ function clearLogs() {
 
 /**
  * Deletes all the logs in the IP_HISTORY sheet
- * leaving the header row
+ * leaving the header row, and forgets the cached network state
  */
 function clearIPHistory() {
+  deleteIPHistoryRows();
+  invalidateNetworkState();
+}
+
+function deleteIPHistoryRows() {
   const lastRow =SHEETS.IP_HISTORY.getLastRow();
   if (lastRow > 1) {
     SHEETS.IP_HISTORY.deleteRows(2, lastRow - 1);
@@ -253,7 +535,7 @@ function clearIPHistory() {
  * @param {object} obj - The object or property to log.
  */
 function logThisObject(objectName, obj) {
-  SHEETS.LOG.appendRow([Date.now(), Date().toString(), objectName, JSON.stringify(obj)]);
+  LOG_BUFFER.push([Date.now(), Date().toString(), objectName, JSON.stringify(obj)]);
 }
 
 /** Appends a new row to the LOG sheet as a [Date in ms, Date readable, eventName, message]
@@ -261,7 +543,19 @@ function logThisObject(objectName, obj) {
  * @param {string} string - The message to log
  */
 function logThisNotice(eventName, message) {
-  SHEETS.LOG.appendRow([Date.now(), Date().toString(), eventName, message]);
+  LOG_BUFFER.push([Date.now(), Date().toString(), eventName, message]);
+}
+
+/**
+ * Writes the rows buffered by logThisObject() and logThisNotice() with a single setValues() call,
+ * then trims the LOG sheet if it went past CONFIG.MAX_LOGS.
+ * doPost() calls this once at the end of every request.
+ */
+function flushLogs() {
+  if (LOG_BUFFER.length === 0) return;
+  const rows = LOG_BUFFER.splice(0, LOG_BUFFER.length);
+  SHEETS.LOG.getRange(SHEETS.LOG.getLastRow() + 1, 1, rows.length, rows[0].length).setValues(rows);
+  clearExceedingLogs();
 }
 
 
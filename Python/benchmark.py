@@ -0,0 +1,293 @@
+'''
+    Offline benchmarks for the client:
+
+        python benchmark.py --output results.json
+        python benchmark.py --output new.json --compare results.json
+
+    Everything runs against a local stand-in for GAS (local_backend.py) that can add latency and answer
+    with the html error page GAS shows when the Sheet is unavailable, so results don't depend on Google.
+    Results are written as JSON; --compare prints how every metric changed against a previous run.
+'''
+import argparse
+from datetime import datetime
+from http.server import ThreadingHTTPServer
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from ip_manager import IPManager
+from local_backend import LocalBackend, RequestHandler, Store
+from logger import Logger
+
+
+
+HTML_ERROR_PAGE = b'<!DOCTYPE html><html><body>Service unavailable</body></html>'
+NETWORK_SIZES = [10, 100, 1000, 10000]
+
+
+class StandInHandler(RequestHandler):
+    '''
+        LocalBackend handler with injected latency and html error pages, also serving our IP on GET /ip
+    '''
+    backend = None
+    latency = 0 # seconds added to every request
+    html_error_rate = 0 # share of POST requests answered with the html error page
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.path == '/ip':
+            self.send_text(b'10.0.0.1')
+        else:
+            super().do_GET()
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        if random.random() < self.html_error_rate:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_text(HTML_ERROR_PAGE)
+        else:
+            super().do_POST()
+
+    def send_text(self, body: bytes):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer:
+    def __init__(self, backend: LocalBackend):
+        self.handler = type('BoundStandInHandler', (StandInHandler,), {'backend': backend})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def configure(self, latency: float = 0, html_error_rate: float = 0):
+        self.handler.latency = latency
+        self.handler.html_error_rate = html_error_rate
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+
+def summarize(timings: list[float]) -> dict:
+    timings = sorted(timings)
+    return {
+        'n': len(timings),
+        'min': timings[0],
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    }
+
+def measure(function, repeat: int, setup=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+def create_config(server_url: str, use_encryption: bool = False, key: str = '') -> dict:
+    return {
+        'GAS_SCRIPT_URL': server_url,
+        'GAS_AUTHCODE': 'benchmark',
+        'IP_SERVICE': f'{server_url}ip',
+        'MACHINE_NAME': 'benchmark',
+        'USE_ENCRYPTED_DATABASE': use_encryption,
+        'IP_ENCRYPTION_KEY': key,
+    }
+
+def create_silent_logger() -> Logger:
+    return Logger(echo=False)
+
+def populate(backend: LocalBackend, size: int, ip_manager: IPManager = None):
+    '''
+        Fills the backend with size devices, encrypted with ip_manager's key if given
+    '''
+    for i in range(size):
+        ip = f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'
+        backend.append_ip(f'device-{i}', ip_manager.encrypt_str(ip) if ip_manager is not None else ip)
+
+
+def bench_update(repeat: int) -> dict:
+    '''
+        End-to-end IPManager.update() latency with different backend latencies and html error rates
+    '''
+    results = {}
+    for latency, html_error_rate in [(0, 0), (0.05, 0), (0.2, 0), (0.05, 0.2)]:
+        backend = LocalBackend(Store(), 'benchmark')
+        populate(backend, 50)
+        server = StandInServer(backend)
+        server.configure(latency, html_error_rate)
+        ip_manager = IPManager(create_config(server.url), create_silent_logger())
+        # Every run starts from a clean client, so that it reports its IP and fetches the whole network
+        def reset():
+            ip_manager.last_reported_ip = None
+            ip_manager.network_version = None
+        results[f'latency_{int(latency * 1000)}ms_html_errors_{int(html_error_rate * 100)}pct'] = measure(ip_manager.update, repeat, reset)
+        server.close()
+    return results
+
+def bench_network_fetch(repeat: int, sizes: list[int]) -> dict:
+    '''
+        get_network_from_GAS() parse and decrypt time, plain and encrypted, with a cold and a warm decryption cache
+    '''
+    from cryptography.fernet import Fernet
+
+    results = {}
+    for size in sizes:
+        for use_encryption in (False, True):
+            key = Fernet.generate_key().decode()
+            backend = LocalBackend(Store(), 'benchmark')
+            server = StandInServer(backend)
+            ip_manager = IPManager(create_config(server.url, use_encryption, key), create_silent_logger())
+            populate(backend, size, ip_manager if use_encryption else None)
+
+            def reset():
+                ip_manager.network_version = None
+            name = f"{size}_devices_{'encrypted' if use_encryption else 'plain'}"
+            if use_encryption:
+                def cold():
+                    reset()
+                    ip_manager.get_cipher().cache.clear()
+                results[f'{name}_cold'] = measure(ip_manager.get_network_from_GAS, max(1, repeat // 2), cold)
+            results[name] = measure(ip_manager.get_network_from_GAS, repeat, reset)
+            server.close()
+    return results
+
+def bench_logger(threads: int = 8, logs_per_thread: int = 5000) -> dict:
+    '''
+        Logger.log() throughput with concurrent writers, and get_logs_as_strings() for the UI
+    '''
+    logger = create_silent_logger()
+
+    def write():
+        for i in range(logs_per_thread):
+            logger.log('benchmark', i, {'key': 'value'})
+
+    workers = [threading.Thread(target=write) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'threads': threads,
+        'logs': threads * logs_per_thread,
+        'seconds': elapsed,
+        'logs_per_second': threads * logs_per_thread / elapsed,
+        'get_logs_as_strings_20': measure(lambda: logger.get_logs_as_strings(20), 100),
+    }
+
+def bench_layout(repeat: int, sizes: list[int]) -> dict:
+    '''
+        Network frame build and filtering time for the main window. Needs PySimpleGUI and a display
+    '''
+    try:
+        import tkinter
+        from devices import Device, DeviceRegistry
+        from network_view import NetworkView
+        root = tkinter.Tk() # like in the app, there's a root window behind the elements
+        root.withdraw()
+        view = NetworkView()
+    except Exception as e:
+        return {'skipped': f'{type(e).__name__}: {e}'}
+
+    results = {}
+    for size in sizes:
+        devices = DeviceRegistry(Device(f'device-{i}', f'10.0.{i // 256 % 256}.{i % 256}') for i in range(size))
+        results[f'{size}_devices'] = measure(lambda: view.create_frame(devices, '10.0.0.0'), repeat)
+        view.filter_text = '10.0.1'
+        results[f'{size}_devices_filtered'] = measure(lambda: view.get_table_contents(devices), repeat)
+        view.filter_text = ''
+    root.destroy()
+    return results
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare(results: dict, previous: dict):
+    '''
+        Prints the change of every median/logs_per_second against a previous run
+    '''
+    current, baseline = flatten(results['results']), flatten(previous['results'])
+    print(f"\nCompared with {previous['meta'].get('commit')} ({previous['meta'].get('timestamp')}):")
+    for key, value in current.items():
+        if not (key.endswith('.median') or key.endswith('logs_per_second')) or not baseline.get(key):
+            continue
+        change = (value - baseline[key]) / baseline[key] * 100
+        print(f'  {key}: {baseline[key]:.6g} -> {value:.6g} ({change:+.1f}%)')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='NetAnchor client benchmarks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='previous results JSON file to compare with')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--sizes', type=int, nargs='+', default=NETWORK_SIZES, help='network sizes to benchmark')
+    parser.add_argument('--only', nargs='+', choices=['update', 'network_fetch', 'logger', 'layout'], help='run only these benchmarks')
+    args = parser.parse_args(argv)
+
+    benchmarks = {
+        'update': lambda: bench_update(args.repeat),
+        'network_fetch': lambda: bench_network_fetch(args.repeat, args.sizes),
+        'logger': bench_logger,
+        'layout': lambda: bench_layout(args.repeat, args.sizes),
+    }
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'commit': get_git_commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+        },
+        'results': {},
+    }
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        print(f'Running {name}...', file=sys.stderr)
+        results['results'][name] = benchmark()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            compare(results, json.load(file))
+
+
+
+if __name__ == '__main__':
+    main()
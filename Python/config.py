@@ -0,0 +1,40 @@
+import copy
+import json
+import os
+
+
+
+DEFAULT_CONFIG = {
+    "GAS_SCRIPT_URL": "",
+    "GAS_AUTHCODE": "",
+    "IP_UPDATE_INTERVAL": 15,
+    "MACHINE_NAME": "NetAnchored Device",
+    "IP_SERVICE": "https://api.ipify.org",
+    "USE_ENCRYPTED_DATABASE": False,
+    "IP_ENCRYPTION_KEY": "",
+    "MAX_UI_LOGS": 10,
+    "SEND_HEARTBEAT": False,
+    "EXTRA_IP_SERVICES": []
+}
+
+
+def load_config(CONFIG_FILE_PATH, logger) -> dict:
+    if os.path.exists(CONFIG_FILE_PATH):
+        logger.log('Config file exists.')
+    else:
+        logger.log('Config file does not exists. Loading default config')
+        return copy.deepcopy(DEFAULT_CONFIG)
+        # raise Exception('Config file not found. Unable to run program.')
+
+
+    logger.log('Loading config...')
+    with open(CONFIG_FILE_PATH, "r") as file:
+        CONFIG = json.load(file)
+    logger.log('Config loaded.')
+    return CONFIG
+
+def save_config(config, CONFIG_FILE_PATH, logger):
+    logger.log('Saving config...')
+    with open(CONFIG_FILE_PATH, "w") as file:
+        json.dump(config, file, indent=4)
+    logger.log('Config saved.')
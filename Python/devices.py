@@ -0,0 +1,122 @@
+import threading
+from typing import Iterable, NamedTuple, Union
+
+
+class Device(NamedTuple):
+  """A device of the network. Records are immutable tuples, a new one replaces it when its IP changes."""
+  label: str
+  ip: str
+  last_seen: float = 0.0 # time.time() when the device was first seen with this IP
+  encrypted: bool = False # True if the IP was encrypted in the database
+
+
+class Changeset(NamedTuple):
+  """What changed in a DeviceRegistry: the added and changed devices (new records) and the removed ones (old records)."""
+  added: list
+  changed: list
+  removed: list
+
+  def is_empty(self) -> bool:
+    return not (self.added or self.changed or self.removed)
+
+  def get_labels(self) -> set:
+    return {device.label for device in self.added + self.changed + self.removed}
+
+
+class DeviceRegistry:
+  """The devices of the network, keyed by label, with a reverse index from IP to labels.
+
+  Every replace() or apply_delta() is O(n) in the devices it's given and only touches the
+  index for the ones that changed. The labels that changed are also collected until someone
+  (the UI) takes them with take_changed_labels(), so that it only redraws those devices.
+  Writes can come from the update thread while the UI reads, so they're done under a lock.
+  """
+
+  def __init__(self, devices: Iterable[Device] = ()):
+    self.devices = {} # label -> Device, in the order the backend sent them
+    self.labels_by_ip = {} # ip -> {label: None}, several devices can share a public IP behind the same NAT
+    self.changed_labels = set()
+    self.revision = 0 # bumped at every change
+    self._lock = threading.Lock()
+    self.replace(devices)
+
+  def __len__(self) -> int:
+    return len(self.devices)
+
+  def __iter__(self):
+    return iter(list(self.devices.values()))
+
+  def __contains__(self, label: str) -> bool:
+    return label in self.devices
+
+  def get(self, label: str) -> Union[Device, None]:
+    return self.devices.get(label)
+
+  def get_labels_by_ip(self, ip: str) -> list[str]:
+    return list(self.labels_by_ip.get(ip, ()))
+
+  def replace(self, devices: Iterable[Device]) -> Changeset:
+    """Replaces the whole network. Devices whose IP didn't change keep their record (and last_seen)."""
+    changeset = Changeset([], [], [])
+    new_devices = {}
+    with self._lock:
+      for device in devices:
+        old_device = self.devices.get(device.label)
+        if old_device is None:
+          changeset.added.append(device)
+        elif old_device.ip != device.ip or old_device.encrypted != device.encrypted:
+          changeset.changed.append(device)
+        else:
+          device = old_device
+        new_devices[device.label] = device
+      changeset.removed.extend(device for label, device in self.devices.items() if label not in new_devices)
+
+      self.update_index(changeset)
+      self.devices = new_devices
+    return changeset
+
+  def apply_delta(self, updated: Iterable[Device], removed: Iterable[str]) -> Changeset:
+    """Adds or replaces the updated devices and drops the removed labels, keeping everything else."""
+    changeset = Changeset([], [], [])
+    with self._lock:
+      devices = dict(self.devices)
+      for device in updated:
+        old_device = devices.get(device.label)
+        if old_device is None:
+          changeset.added.append(device)
+        elif old_device.ip != device.ip or old_device.encrypted != device.encrypted:
+          changeset.changed.append(device)
+        else:
+          continue
+        devices[device.label] = device
+      for label in removed:
+        if label in devices:
+          changeset.removed.append(devices.pop(label))
+
+      self.update_index(changeset)
+      self.devices = devices
+    return changeset
+
+  def update_index(self, changeset: Changeset) -> None:
+    # The same label can come twice in a batch (e.g. records of an old and a new key), so old records may be missing
+    old_devices = [self.devices.get(device.label) for device in changeset.changed]
+    for device in changeset.removed + [device for device in old_devices if device is not None]:
+      labels = self.labels_by_ip.get(device.ip, {})
+      labels.pop(device.label, None)
+      if not labels:
+        self.labels_by_ip.pop(device.ip, None)
+    for device in changeset.added + changeset.changed:
+      self.labels_by_ip.setdefault(device.ip, {})[device.label] = None
+    self.changed_labels.update(changeset.get_labels())
+    if not changeset.is_empty():
+      self.revision += 1
+
+  def take_changed_labels(self) -> set:
+    """Returns the labels that changed since the last call."""
+    with self._lock:
+      changed_labels, self.changed_labels = self.changed_labels, set()
+    return changed_labels
+
+  def to_list(self) -> list[list]:
+    """[label, ip, last_seen, encrypted] records, e.g. to be saved as json."""
+    return [list(device) for device in self]
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from ip_discovery import IPDiscovery, create_provider, is_valid_ipv4
+from ip_manager import is_unknown_request
+
+
+PUBLIC_IP_SOURCE = 'public' # the public IP of the gateway itself, shared by the hosts behind the same router
+
+
+class Gateway:
+  """Reports the IPs of many devices from a single agent (gateway mode, enabled by GATEWAY_DEVICES).
+
+  Every device has a label and an IP source: "public" for the public IP of the gateway, looked up
+  once per update for all the devices using it, or any IP provider spec for a lookup of its own,
+  e.g. "interface:eth1" for the address of an uplink, or an http(s) url, "stun:" or "dns:" probe.
+  The IPs that changed are sent in a single UPDATE_IPS request, which also answers with the network
+  like REPORT_AND_FETCH. Older backends get one UPDATE_IP request per device instead.
+  """
+
+  def __init__(self, ip_manager, devices: list[dict]):
+    self.ip_manager = ip_manager
+    self.logger = ip_manager.logger
+    self.metrics = ip_manager.metrics
+    self.sources = {} # label -> IPDiscovery, None for the public IP
+    for device in devices:
+      source = device.get('source', PUBLIC_IP_SOURCE)
+      self.sources[device['label']] = None if source == PUBLIC_IP_SOURCE else IPDiscovery(
+        [create_provider(source, ip_manager.transport)],
+        self.logger,
+        race_width=1,
+        timeout=ip_manager.ip_service_timeout[-1],
+        metrics=self.metrics,
+      )
+    self.last_reported_ips = {} # label -> the last IP GAS acknowledged for it
+    self.supports_update_ips = True # set to False once the backend turns out to be an older deployment
+
+  def update(self) -> bool:
+    return asyncio.run(self.async_update())
+
+  def get_state(self) -> tuple:
+    """Same as IPManager.get_state(), also changing with the IPs of our devices."""
+    return (self.ip_manager.get_state(), tuple(self.last_reported_ips.items()))
+
+  async def async_update(self) -> bool:
+    """Looks up the IPs of all the devices at the same time, then reports the ones that changed."""
+    start = time.monotonic()
+    fetched_at = self.ip_manager.network_fetched_at
+    ips = await self.collect_ips()
+    updates = {label: ip for label, ip in ips.items() if ip != self.last_reported_ips.get(label)}
+    self.logger.log(f'Gateway: {len(updates)} of {len(self.sources)} IPs changed')
+
+    if self.supports_update_ips:
+      await asyncio.to_thread(self.report_ips, updates)
+    # Older GAS deployments only understand the separate requests
+    if not self.supports_update_ips:
+      await asyncio.to_thread(self.report_ips_separately, updates)
+      await asyncio.to_thread(self.ip_manager.fetch_network)
+    success = self.ip_manager.network_fetched_at != fetched_at
+    self.metrics.observe('gateway_update', time.monotonic() - start, success)
+    return success
+
+  async def collect_ips(self) -> dict:
+    """Returns {label: ip} for the devices whose IP could be retrieved."""
+    probed_labels = [label for label, source in self.sources.items() if source is not None]
+    public_ip_lookup = asyncio.to_thread(self.ip_manager.get_own_ip) if len(probed_labels) < len(self.sources) else asyncio.sleep(0)
+    public_ip, *probed_ips = await asyncio.gather(public_ip_lookup, *[asyncio.to_thread(self.sources[label].lookup) for label in probed_labels])
+    if public_ip is not None and is_valid_ipv4(public_ip):
+      self.ip_manager.last_known_ip = public_ip
+    probed_ips = dict(zip(probed_labels, probed_ips))
+
+    ips = {}
+    for label, source in self.sources.items():
+      ip = public_ip if source is None else probed_ips[label]
+      if ip is None or not is_valid_ipv4(ip):
+        self.logger.log(f'Unable to retrieve IP for {label}')
+        continue
+      ips[label] = ip
+    return ips
+
+  def report_ips(self, updates: dict) -> bool:
+    """Sends the changed IPs and fetches the network in a single UPDATE_IPS request.
+
+    Returns:
+      bool: True if the backend answered with the network. If it turns out not to understand
+        UPDATE_IPS (older GAS deployments) supports_update_ips is set to False
+    """
+    ip_manager = self.ip_manager
+    self.logger.log(f'Reporting {len(updates)} IPs to GAS and requesting network...')
+    data = {
+      'authCode': ip_manager.gas_auth_code,
+      'serviceName': ip_manager.machine_label,
+      'requestType': 'UPDATE_IPS',
+      'updates': [list(ip_manager.encode_record(label, ip)) for label, ip in updates.items()],
+      'heartbeat': ip_manager.send_heartbeat,
+      'networkVersion': ip_manager.network_version,
+      'compression': 'gzip',
+    }
+    response = ip_manager.post_to_gas(data)
+
+    if response is None:
+      return False
+    if is_unknown_request(response):
+      self.logger.log('Backend does not support UPDATE_IPS, falling back to separate requests')
+      self.supports_update_ips = False
+      return False
+    if response.get('status') != 200 or not isinstance(response.get('value'), (list, dict)):
+      self.logger.log(f"ERROR: UPDATE_IPS failed: {response.get('message')}")
+      return False
+    self.last_reported_ips.update(updates)
+    ip_manager.apply_network_response(response['value'])
+    return True
+
+  def report_ips_separately(self, updates: dict) -> None:
+    for label, ip in updates.items():
+      if self.ip_manager.send_ip_to_gas(ip, label):
+        self.last_reported_ips[label] = ip
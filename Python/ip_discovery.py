@@ -0,0 +1,284 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import ipaddress
+import os
+import random
+import socket
+import statistics
+import struct
+import threading
+import time
+from typing import Union
+
+import requests
+
+
+STUN_MAGIC_COOKIE = 0x2112A442
+SIOCGIFADDR = 0x8915 # Linux ioctl reading the IPv4 address of an interface
+
+
+class ProviderStats:
+  """Rolling latency and failure stats of an IP discovery provider."""
+
+  def __init__(self, window: int = 20):
+    self.latencies = deque(maxlen=window) # seconds, successful lookups only
+    self.results = deque(maxlen=window) # True for success, False for failure
+    self.consecutive_failures = 0
+
+  def record(self, success: bool, latency: float):
+    self.results.append(success)
+    if success:
+      self.latencies.append(latency)
+      self.consecutive_failures = 0
+    else:
+      self.consecutive_failures += 1
+
+  def is_healthy(self) -> bool:
+    return self.consecutive_failures < 3
+
+  def mean_latency(self) -> float:
+    if self.latencies:
+      return statistics.fmean(self.latencies)
+    # Providers never tried yet are ranked as if they were fast, so that they get measured
+    return 0 if not self.results else float('inf')
+
+  def failure_rate(self) -> float:
+    return self.results.count(False) / len(self.results) if self.results else 0
+
+  def as_dict(self) -> dict:
+    return {
+      'mean_latency': self.mean_latency(),
+      'failure_rate': self.failure_rate(),
+      'consecutive_failures': self.consecutive_failures,
+      'lookups': len(self.results),
+    }
+
+
+class IPProvider:
+  """Something that can tell us our public IP. Subclasses implement lookup()."""
+
+  def __init__(self, spec: str):
+    self.spec = spec
+    self.stats = ProviderStats()
+
+  def lookup(self, timeout: float) -> str:
+    raise NotImplementedError
+
+  def __repr__(self):
+    return self.spec
+
+
+class HTTPProvider(IPProvider):
+  """Plain-text HTTP(S) endpoint answering with the IP, like ipify."""
+
+  def __init__(self, spec: str, transport=None):
+    super().__init__(spec)
+    self.transport = transport
+
+  def lookup(self, timeout: float) -> str:
+    # The race already gives us redundancy, so no retries: a slow provider just loses
+    if self.transport is not None:
+      response = self.transport.get(self.spec, timeout=timeout, retries=0)
+    else:
+      response = requests.get(self.spec, timeout=timeout)
+    response.raise_for_status()
+    # Decoded by hand: on a bare "1.2.3.4" without a charset requests' encoding detection can go astray
+    return response.content.decode('ascii', errors='replace').strip()
+
+
+class STUNProvider(IPProvider):
+  """STUN server, spec "stun:host:port". Sends a binding request and reads the mapped address."""
+
+  def __init__(self, spec: str):
+    super().__init__(spec)
+    _, self.host, port = spec.split(':')
+    self.port = int(port)
+
+  def lookup(self, timeout: float) -> str:
+    transaction_id = os.urandom(12)
+    request = struct.pack('!HHI12s', 0x0001, 0, STUN_MAGIC_COOKIE, transaction_id)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+      sock.settimeout(timeout)
+      sock.sendto(request, (socket.gethostbyname(self.host), self.port))
+      data, _ = sock.recvfrom(2048)
+
+    message_type, length, _, response_id = struct.unpack('!HHI12s', data[:20])
+    if message_type != 0x0101 or response_id != transaction_id:
+      raise ValueError('Unexpected STUN response')
+
+    mapped_address = None
+    offset = 20
+    while offset + 4 <= 20 + length:
+      attribute_type, attribute_length = struct.unpack('!HH', data[offset:offset + 4])
+      value = data[offset + 4:offset + 4 + attribute_length]
+      if attribute_type == 0x0020 and value[1] == 0x01: # XOR-MAPPED-ADDRESS, IPv4
+        return str(ipaddress.IPv4Address(struct.unpack('!I', value[4:8])[0] ^ STUN_MAGIC_COOKIE))
+      if attribute_type == 0x0001 and value[1] == 0x01: # MAPPED-ADDRESS, IPv4 (old servers)
+        mapped_address = str(ipaddress.IPv4Address(value[4:8]))
+      offset += 4 + (attribute_length + 3) // 4 * 4 # attributes are padded to 4 bytes
+
+    if mapped_address is None:
+      raise ValueError('No mapped address in STUN response')
+    return mapped_address
+
+
+class DNSProvider(IPProvider):
+  """DNS-based lookup, spec "dns:name@resolver", e.g. "dns:myip.opendns.com@resolver1.opendns.com".
+
+  The resolver answers an A query for name with the address the query came from.
+  """
+
+  def __init__(self, spec: str):
+    super().__init__(spec)
+    self.name, self.resolver = spec[len('dns:'):].split('@')
+
+  def lookup(self, timeout: float) -> str:
+    query_id = random.getrandbits(16)
+    question = b''.join(bytes([len(part)]) + part.encode() for part in self.name.split('.')) + b'\0'
+    query = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + question + struct.pack('!HH', 1, 1)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+      sock.settimeout(timeout)
+      sock.sendto(query, (socket.gethostbyname(self.resolver), 53))
+      data, _ = sock.recvfrom(512)
+
+    response_id, flags, _, answer_count, _, _ = struct.unpack('!HHHHHH', data[:12])
+    if response_id != query_id or flags & 0x000F != 0:
+      raise ValueError('Unexpected DNS response')
+
+    offset = 12 + len(question) + 4
+    for _ in range(answer_count):
+      offset = skip_dns_name(data, offset)
+      record_type, _, _, data_length = struct.unpack('!HHIH', data[offset:offset + 10])
+      offset += 10
+      if record_type == 1 and data_length == 4: # A record
+        return str(ipaddress.IPv4Address(data[offset:offset + 4]))
+      offset += data_length
+    raise ValueError('No A record in DNS response')
+
+
+class InterfaceProvider(IPProvider):
+  """Address of a local network interface, spec "interface:name", e.g. "interface:eth1".
+
+  Only useful when the interface holds the public IP itself, like an uplink on a bridged modem.
+  Linux only.
+  """
+
+  def __init__(self, spec: str):
+    super().__init__(spec)
+    self.interface = spec[len('interface:'):]
+
+  def lookup(self, timeout: float) -> str:
+    import fcntl # not available on Windows
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+      request = struct.pack('256s', self.interface[:15].encode())
+      return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+
+
+class IPDiscovery:
+  """Finds our public IP by racing several providers.
+
+  The fastest healthy providers are queried first, `race_width` at a time: the first valid
+  answer wins, and every failure starts the next provider in line. With require_agreement
+  the lookup only succeeds once two providers have returned the same IP, so it's ignored
+  when there aren't two providers to agree.
+  """
+
+  def __init__(self, providers: list[IPProvider], logger=None, race_width: int = 2,
+               require_agreement: bool = False, timeout: float = 5, metrics=None):
+    self.providers = providers
+    self.logger = logger
+    self.race_width = race_width
+    self.require_agreement = require_agreement and len(providers) >= 2
+    if require_agreement and not self.require_agreement:
+      self.log('WARNING: IP_DISCOVERY_REQUIRE_AGREEMENT needs at least two IP providers (add some to EXTRA_IP_SERVICES), ignoring it')
+    self.timeout = timeout
+    self.metrics = metrics
+    self.executor = ThreadPoolExecutor(max_workers=max(1, len(providers)), thread_name_prefix='IPDiscovery')
+    self._lock = threading.Lock()
+
+  def get_ranked_providers(self) -> list[IPProvider]:
+    with self._lock:
+      return sorted(self.providers, key=lambda provider: (not provider.stats.is_healthy(), provider.stats.mean_latency()))
+
+  def lookup(self) -> Union[str, None]:
+    """Returns our public IP, or None if no provider (or no two providers) could tell."""
+    waiting = self.get_ranked_providers()
+    running = set()
+    answers = {} # ip -> number of providers that returned it
+    deadline = time.monotonic() + self.timeout * 2
+
+    while waiting or running:
+      while waiting and len(running) < self.race_width:
+        provider = waiting.pop(0)
+        running.add(self.executor.submit(self.query, provider))
+
+      done, running = wait(running, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+      if not done:
+        self.log('IP lookup timed out')
+        break
+
+      for future in done:
+        ip = future.result()
+        if ip is None:
+          continue
+        answers[ip] = answers.get(ip, 0) + 1
+        if not self.require_agreement or answers[ip] >= 2:
+          return ip
+
+    if self.require_agreement and answers:
+      self.log(f'IP providers did not agree: {answers}')
+    return None
+
+  def query(self, provider: IPProvider) -> Union[str, None]:
+    start = time.monotonic()
+    try:
+      ip = provider.lookup(self.timeout)
+      if not is_valid_ipv4(ip):
+        raise ValueError(f'invalid IP {ip!r}')
+    except Exception as e:
+      self.log(f'IP provider {provider} failed: {e}')
+      ip = None
+    duration = time.monotonic() - start
+    with self._lock:
+      provider.stats.record(ip is not None, duration)
+    if self.metrics is not None:
+      self.metrics.observe('ip_provider', duration, ip is not None, provider.spec)
+    return ip
+
+  def get_stats(self) -> dict:
+    with self._lock:
+      return {provider.spec: provider.stats.as_dict() for provider in self.providers}
+
+  def log(self, *args):
+    if self.logger is not None:
+      self.logger.log(*args)
+
+
+
+def create_provider(spec: str, transport=None) -> IPProvider:
+  if spec.startswith('stun:'):
+    return STUNProvider(spec)
+  if spec.startswith('dns:'):
+    return DNSProvider(spec)
+  if spec.startswith('interface:'):
+    return InterfaceProvider(spec)
+  return HTTPProvider(spec, transport)
+
+def is_valid_ipv4(ip: str) -> bool:
+  try:
+    ipaddress.IPv4Address(ip)
+    return True
+  except ValueError:
+    return False
+
+def skip_dns_name(data: bytes, offset: int) -> int:
+  while True:
+    length = data[offset]
+    if length & 0xC0 == 0xC0: # compression pointer, the name ends here
+      return offset + 2
+    if length == 0:
+      return offset + 1
+    offset += 1 + length
@@ -1,14 +1,26 @@
-from cryptography.fernet import Fernet
+import asyncio
+import base64
+from datetime import datetime
+import gzip
 import json
-import re
+import os
 import requests
+import time
 from typing import Union
 from urllib.parse import urlparse
 
+from devices import Device, DeviceRegistry
+from metrics import Metrics
+from network_cache import NetworkCache
+from ip_discovery import IPDiscovery, create_provider, is_valid_ipv4
+from transport import Transport, is_html_error_page, is_no_return_page
+
+
+DECRYPTION_ERROR = 'Unable to decrypt' # shown in place of the IPs that can't be decrypted with our keys
 
 
 class IPManager:
-  def __init__(self, CONFIG: dict, logger=None, network=[], last_known_ip=None):
+  def __init__(self, CONFIG: dict, logger=None, devices=None, last_known_ip=None, transport=None, cache_path=None, metrics=None):
     self.CONFIG = CONFIG
     self.gas_script_url = CONFIG['GAS_SCRIPT_URL']
     self.gas_auth_code = CONFIG['GAS_AUTHCODE']
@@ -16,141 +28,390 @@ class IPManager:
     self.machine_label = CONFIG['MACHINE_NAME']
     self.get_own_ip_attempts = 0
     self.last_known_ip = last_known_ip
-    self.encryption_key = CONFIG['IP_ENCRYPTION_KEY'] if CONFIG['IP_ENCRYPTION_KEY'] != '' else Fernet.generate_key()
-    self.network = network # this is useful to update this instance coming from another one (check open_config_window() in main.py)
+    self.last_reported_ip = None # the last IP GAS acknowledged, used to skip writes when it doesn't change
+    # Same as Fernet.generate_key(), without importing cryptography when encryption isn't used
+    self.encryption_key = CONFIG['IP_ENCRYPTION_KEY'] if CONFIG['IP_ENCRYPTION_KEY'] != '' else base64.urlsafe_b64encode(os.urandom(32))
+    self.cipher = None # built on first use by get_cipher()
+    # 1: label and IP encrypted as separate Fernet tokens, 2: compact records (see NetworkCipher), readable by updated clients only
+    self.record_format = CONFIG.get('RECORD_FORMAT', 1)
+    self.network_version = None # version of self.devices according to GAS, None until a versioned backend answers
+    self.labels_by_service_name = {} # label id -> label of the compact records, GAS removes them by label id
+    # Passing the devices is useful to update this instance coming from another one (check open_config_window() in main.py)
+    self.devices = devices if devices is not None else DeviceRegistry()
+    self.network_fetched_at = None # when the network was last fetched from GAS
+    self.network_is_cached = False # True while the network comes from the local cache and hasn't been refreshed yet
     self.logger = logger
+    # The transport is shared between instances so the pooled connections survive a config change
+    self.transport = transport if transport is not None else Transport(logger)
+    self.metrics = metrics if metrics is not None else Metrics() # shared between instances like the transport
+    self.ip_service_timeout = tuple(CONFIG.get('IP_SERVICE_TIMEOUT', (3, 5))) # (connect, read) seconds
+    self.gas_timeout = tuple(CONFIG.get('GAS_TIMEOUT', (5, 30))) # GAS can take a while to answer
+    self.ip_discovery = IPDiscovery(
+      # IP_SERVICE stays the preferred one, EXTRA_IP_SERVICES can be http(s) urls, "stun:host:port" or "dns:name@resolver"
+      [create_provider(spec, self.transport) for spec in dict.fromkeys([self.ip_service] + CONFIG.get('EXTRA_IP_SERVICES', []))],
+      logger,
+      race_width=CONFIG.get('IP_DISCOVERY_RACE_WIDTH', 2),
+      require_agreement=CONFIG.get('IP_DISCOVERY_REQUIRE_AGREEMENT', False),
+      timeout=self.ip_service_timeout[-1],
+      metrics=self.metrics,
+    )
+
+    self.send_heartbeat = bool(CONFIG.get('SEND_HEARTBEAT', False)) # lets GAS know we're alive even when the IP doesn't change
+    self.supports_report_and_fetch = True # set to False once the backend turns out to be an older deployment
 
     self.network_has_been_given = False
 
     if logger == None:
       raise Exception('Logger not set. Exiting program.')
 
+    # The last good network is kept on disk (encrypted like the database) to be shown right away at the next startup
+    self.cache = NetworkCache(cache_path, self.get_cipher() if CONFIG['USE_ENCRYPTED_DATABASE'] else None, logger) if cache_path else None
+
 
   def get_own_ip(self) -> Union[str, None]:
-    """Sends a GET request to the IP retrieval service of choice.
+    """Races the configured IP retrieval services, see IPDiscovery.
 
     Returns:
       Union[str, None]: either the current IP (str) or None if retrieval fails
     """
     self.logger.log('Getting own IP...')
-    try:
-      ip = requests.get(self.ip_service).text
-    except requests.exceptions.RequestException as e:
-      self.logger.log(e)
-      ip = None
+    with self.metrics.timer('ip_lookup') as result:
+      ip = self.ip_discovery.lookup()
+      result['success'] = ip is not None
     return ip
 
-  def send_ip_to_gas(self, current_ip: str) -> None:
-    self.logger.log('Sending own IP to GAS...')
+  def post_to_gas(self, data: dict) -> Union[dict, None]:
+    """Sends a request to the GAS web app, timing it per requestType. Only 200 replies count as successes.
+
+    Returns:
+      Union[dict, None]: the parsed {status, message, value} response, or None if the request failed
+    """
+    with self.metrics.timer('gas_request', data['requestType']) as result:
+      response = self.request_gas(data)
+      result['success'] = response is not None and response.get('status') == 200
+    return response
+
+  def request_gas(self, data: dict) -> Union[dict, None]:
     address = self.gas_script_url
     headers = {'Content-Type': 'application/json'}
-    ip_to_send = self.encrypt_str(current_ip) if self.CONFIG['USE_ENCRYPTED_DATABASE'] else current_ip
-    machine_label = self.encrypt_str(self.machine_label) if self.CONFIG['USE_ENCRYPTED_DATABASE'] else self.machine_label
+
+    if not is_valid_url(address):
+      self.logger.log(f'Invalid url: {address}')
+      return None
+
+    try:
+      response = self.transport.post(address, headers=headers, data=json.dumps(data), timeout=self.gas_timeout)
+    except requests.exceptions.RequestException as e:
+      self.logger.log(f'ERROR: request to GAS failed: {e}')
+      return None
+
+    # Older deployments don't answer to the requestTypes they don't know: reply like the newer ones do
+    if is_no_return_page(response):
+      self.logger.log(f"Backend did not answer to {data['requestType']}, it is probably an older deployment")
+      return {'status': 400, 'message': f"Unknown requestType: {data['requestType']}", 'value': None}
+
+    # Ignore html messages from GAS
+    if is_html_error_page(response):
+      self.logger.log('ERROR: received html data from server. Database sheet is probably offline, try again later')
+      return None
+
+    self.logger.log('Response from server: ', response.text)
+    try:
+      contents = json.loads(response.content)
+      # Backends that understand "compression" send large networks gzipped, older ones just ignore it
+      if isinstance(contents.get('value'), dict) and contents['value'].get('compressed') == 'gzip':
+        contents['value'] = json.loads(gzip.decompress(base64.b64decode(contents['value']['data'])))
+      return contents
+    except (ValueError, KeyError, OSError, AttributeError):
+      self.logger.log('ERROR: unable to parse the response from server')
+      return None
+
+  def send_ip_to_gas(self, current_ip: str, machine_label: str = None) -> bool:
+    """Sends current_ip as the IP of machine_label, our own MACHINE_NAME by default."""
+    machine_label = machine_label if machine_label is not None else self.machine_label
+    self.logger.log(f'Sending IP of {machine_label} to GAS...')
+    service_name, ip_to_send = self.encode_record(machine_label, current_ip)
 
     data = {
       'authCode': self.gas_auth_code,
       # TODO "serviceName" should be changed to "machineLabel", but we have to sync this change with GAS routes or the program breaks
-      'serviceName': machine_label,
+      'serviceName': service_name,
       'requestType': 'UPDATE_IP',
       'ip': ip_to_send,
     }
     self.logger.log(f'Sending this to GAS: ', data)
-    
-    if not is_valid_url(address):
-      self.logger.log(f'Invalid url: {address}')
-      return
-    
-    response = requests.post(address, headers=headers, data=json.dumps(data))
+    return self.post_to_gas(data) is not None
 
-    # Ignore html messages from GAS
-    if '<!DOCTYPE html>' in response.text:
-      self.logger.log('ERROR: received html data from server. Database sheet is probably offline, try again later')
-      return
-    
-    self.logger.log('Response from server: ', response.text)
+  def report_and_fetch(self, current_ip: Union[str, None]) -> bool:
+    """Reports the current IP and fetches the network in a single REPORT_AND_FETCH request.
 
-  def update(self) -> list[str]:
+    Args:
+      current_ip (Union[str, None]): the IP to record, or None if it hasn't changed since the last report
+
+    Returns:
+      bool: True if the backend answered with the network. If it turns out not to understand
+        REPORT_AND_FETCH (older GAS deployments) supports_report_and_fetch is set to False
+    """
+    self.logger.log('Reporting to GAS and requesting network...')
+    service_name, ip_to_send = self.encode_record(self.machine_label, current_ip)
+    data = {
+      'authCode': self.gas_auth_code,
+      'serviceName': service_name,
+      'requestType': 'REPORT_AND_FETCH',
+      'ip': ip_to_send,
+      'heartbeat': self.send_heartbeat,
+      'networkVersion': self.network_version,
+      'compression': 'gzip',
+    }
+    self.logger.log(f'Sending this to GAS: ', data)
+    response = self.post_to_gas(data)
+
+    if response is None:
+      return False
+    if is_unknown_request(response):
+      self.logger.log('Backend does not support REPORT_AND_FETCH, falling back to separate requests')
+      self.supports_report_and_fetch = False
+      return False
+    # Anything else (401, a 500 on a busy Sheet...) is a failure of this request only
+    if response.get('status') != 200 or not isinstance(response.get('value'), (list, dict)):
+      self.logger.log(f"ERROR: REPORT_AND_FETCH failed: {response.get('message')}")
+      return False
+    self.apply_network_response(response['value'])
+    return True
+
+  def encode_record(self, label: str, ip: Union[str, None]) -> tuple:
+    """Returns the (serviceName, ip) to send for label, encrypted according to USE_ENCRYPTED_DATABASE and RECORD_FORMAT.
+
+    Without an IP there's nothing to encrypt the label with, so only compact records hide it (behind its label id).
+    """
+    if not self.CONFIG['USE_ENCRYPTED_DATABASE']:
+      return label, ip
+    if self.record_format == 2:
+      return self.get_cipher().get_label_id(label), self.get_cipher().encrypt_record(label, ip) if ip is not None else None
+    if ip is None:
+      return label, None
+    return self.encrypt_str(label), self.encrypt_str(ip)
+
+  def update(self) -> bool:
+    return asyncio.run(self.async_update())
+
+  async def async_update(self) -> bool:
+    """Runs an update cycle, looking up our own IP and fetching the network at the same time.
+
+    The requests themselves are blocking, so they run in worker threads on the shared transport.
+    Our IP is reported with a second request only when the lookup shows that it changed.
+
+    Returns:
+      bool: True if the network has been synced
+    """
+    start = time.monotonic()
+    fetched_at = self.network_fetched_at
+    current_ip, _ = await asyncio.gather(asyncio.to_thread(self.get_own_ip), asyncio.to_thread(self.fetch_network))
+    ip_to_report = self.check_own_ip(current_ip)
+
+    if ip_to_report is not None and await asyncio.to_thread(self.report_ip, ip_to_report):
+      self.last_reported_ip = ip_to_report
+    # A cycle is successful when the network has been synced
+    success = self.network_fetched_at != fetched_at
+    self.metrics.observe('update', time.monotonic() - start, success)
+    return success
+
+  def check_own_ip(self, current_ip: Union[str, None]) -> Union[str, None]:
+    """Validates the IP returned by get_own_ip() and stores it as the last known one.
+
+    Returns:
+      Union[str, None]: the IP if it has to be reported to GAS, None if it's invalid or unchanged
+    """
     self.get_own_ip_attempts += 1
-    current_ip = self.get_own_ip()
+    ip_to_report = None
 
     if current_ip is None:
       self.logger.log("Unable to retrieve IP")
     elif not self.is_valid_ipv4(current_ip):
       self.logger.log(f'Failed to retrieve valid ip address ({self.get_own_ip_attempts} tries)')
-    elif self.is_valid_ipv4(current_ip):
-      self.send_ip_to_gas(current_ip)
+    else:
       self.last_known_ip = current_ip
+      if current_ip == self.last_reported_ip:
+        self.logger.log('IP unchanged, skipping update')
+      else:
+        ip_to_report = current_ip
     self.get_own_ip_attempts = 0
-    self.get_network_from_GAS()
+    return ip_to_report
+
+  def fetch_network(self) -> None:
+    if self.supports_report_and_fetch:
+      self.report_and_fetch(None)
+    # Older GAS deployments only understand the separate requests
+    if not self.supports_report_and_fetch:
+      self.get_network_from_GAS()
+
+  def report_ip(self, current_ip: str) -> bool:
+    if self.supports_report_and_fetch:
+      return self.report_and_fetch(current_ip)
+    return self.send_ip_to_gas(current_ip)
 
 
   def get_network_from_GAS(self) -> list[str]:
     self.logger.log('Requesting network to GAS...')
-    address = self.gas_script_url
-    headers = {'Content-Type': 'application/json'}
     data = {
       'authCode': self.gas_auth_code,
       'serviceName': self.machine_label,
       'requestType': 'REQUEST_NETWORK',
       'ip': self.last_known_ip,
+      'networkVersion': self.network_version,
+      'compression': 'gzip',
     }
 
-    if not is_valid_url(address):
-      self.logger.log(f'Invalid url: {address}')
+    response = self.post_to_gas(data)
+    if response is None or not isinstance(response.get('value'), (list, dict)):
       return
-    
-    response = requests.post(address, headers=headers, data=json.dumps(data))
+    self.apply_network_response(response['value'])
 
-    # Ignore html messages from GAS
-    if '<!DOCTYPE html>' in response.text:
-      self.logger.log('ERROR: received html data from server. Database sheet is probably offline, try again later')
+  def apply_network_response(self, value: Union[list, dict]) -> None:
+    """Applies the network sent by GAS.
+
+    Older deployments always send the whole network as a list of [label, ip]. Versioned ones
+    send {version, unchanged: true}, {version, network: [...]} or a delta
+    {version, added: [...], changed: [...], removed: [label, ...]} against our network_version.
+    """
+    if isinstance(value, list):
+      self.network_version = None
+      self.set_network(value)
+    else:
+      if value.get('unchanged'):
+        self.logger.log(f'Network unchanged (version {value["version"]})')
+      elif 'network' in value:
+        self.set_network(value['network'])
+      else:
+        self.apply_network_delta(value.get('added', []), value.get('changed', []), value.get('removed', []))
+      self.network_version = value['version']
+
+    self.network_fetched_at = datetime.now()
+    self.network_is_cached = False
+    self.metrics.set_gauge('last_successful_sync_timestamp_seconds', time.time())
+    self.metrics.set_gauge('network_size', len(self.devices))
+    if self.cache is not None:
+      self.cache.save(self.devices.to_list(), self.last_known_ip, self.network_version, self.labels_by_service_name)
+
+  def load_cached_network(self) -> bool:
+    """Loads the network saved by the last run, to be shown until GAS answers.
+
+    Returns:
+      bool: True if a cached network was found
+    """
+    cached = self.cache.load() if self.cache is not None else None
+    if cached is None:
+      return False
+
+    self.logger.log(f"Loaded cached network from {cached['fetched_at'].strftime('%Y-%m-%d %H:%M:%S')}")
+    self.devices.replace(Device(*record) for record in cached['network'])
+    self.network_version = cached['network_version']
+    self.labels_by_service_name = cached.get('labels_by_service_name', {})
+    self.network_fetched_at = cached['fetched_at']
+    self.network_is_cached = True
+    self.network_has_been_given = False
+    if self.last_known_ip is None:
+      self.last_known_ip = cached['current_ip']
+    return True
+
+  def is_network_cached(self) -> bool:
+    return self.network_is_cached
+
+  def apply_network_delta(self, added: list, changed: list, removed: list) -> None:
+    self.logger.log(f'Network delta: {len(added)} added, {len(changed)} changed, {len(removed)} removed')
+    updated = self.decrypt_network(added + changed)
+    self.log_network_changes(self.devices.apply_delta(updated, self.get_removed_labels(removed)))
+
+  def get_removed_labels(self, removed: list) -> list:
+    """Translates the service names removed by GAS to the labels of our devices (compact records are stored under label ids)."""
+    labels = []
+    for service_name in removed:
+      label = self.labels_by_service_name.pop(service_name, service_name)
+      # After a key rotation the same device can be stored under two label ids, keep it while one is left
+      if label == service_name or label not in self.labels_by_service_name.values():
+        labels.append(label)
+    return labels
+
+  def set_network(self, values: list) -> None:
+    self.labels_by_service_name = {}
+    self.log_network_changes(self.devices.replace(self.decrypt_network(values)))
+
+  def log_network_changes(self, changeset) -> None:
+    if changeset.is_empty():
       return
+    self.network_has_been_given = False
+    self.logger.log(f'Network: {len(changeset.added)} added, {len(changeset.changed)} changed, {len(changeset.removed)} removed')
+    for device in changeset.added + changeset.changed:
+      self.logger.log([device.label, device.ip])
+
+  def decrypt_network(self, values: list) -> list[Device]:
+    now = time.time()
+    fetched_network = [[value[0], value[1]] for value in values]
 
-    self.logger.log('Response from server: ', response.text)    
-    fetched_network = [[value[0], value[1]] for value in json.loads(response.content)['value']]
+    # If it's not a valid ip, it could be an encrypted string, so we try to decrypt it
+    encrypted_records = [record for record in fetched_network if not self.is_valid_ipv4(record[1])]
+    if len(encrypted_records) == 0:
+      return [Device(label, ip, now) for label, ip in fetched_network]
 
-    for record in fetched_network:
-      if not self.is_valid_ipv4(record[1]): # If it's not valid ip, it could be an encrypted string, so it tries to decrypt it
-        self.logger.log('IP is encrypted. Decoding...')
-        # TODO an error is raised if the encryption key is wrong. Should return something to the UI
-        decoded_ip = self.decrypt_str(record[1])
-        if self.is_valid_ipv4(decoded_ip):
-          self.logger.log('IP decoded.')
+    self.logger.log(f'{len(encrypted_records)} IPs are encrypted. Decoding...')
+    failures = 0
+    with self.metrics.timer('decrypt') as result:
+      for record, decoded_ip in zip(encrypted_records, self.get_cipher().decrypt_many([record[1] for record in encrypted_records])):
+        if isinstance(decoded_ip, tuple): # compact record, stored under its label id
+          label, decoded_ip = decoded_ip
+          self.labels_by_service_name[record[0]] = label
+          record[0] = label
+        if decoded_ip is not None and self.is_valid_ipv4(decoded_ip):
           record[1] = decoded_ip
         else:
-          raise Exception('Error decrypting IP') # ? This could just update the fetched network with the same string
-        
-    self.network = fetched_network
-    self.network_has_been_given = False
-    self.logger.log('Network: ')
-    for entry in self.network:
-      self.logger.log(entry)
-  
+          # Most likely encrypted with a different key: mark this record instead of losing the whole network
+          record[1] = DECRYPTION_ERROR
+          failures += 1
+      result['success'] = failures == 0
+
+    if failures > 0:
+      self.logger.log(f'ERROR: unable to decrypt {failures} IPs. Check the encryption key')
+    else:
+      self.logger.log('IPs decoded.')
+    encrypted_labels = {record[0] for record in encrypted_records}
+    return [Device(label, ip, now, label in encrypted_labels) for label, ip in fetched_network]
+
   def has_network_been_given(self):
     return self.network_has_been_given
 
   def is_valid_ipv4(self, ip: str) -> bool:
-    pattern = r"^(?:\d{1,3}\.){3}\d{1,3}$"
-    return bool(re.match(pattern, ip))
+    return is_valid_ipv4(ip)
 
   def encrypt_str(self, string_to_encrypt: str) -> str:
-    cipher_suite = Fernet(self.encryption_key)
-    encrypted_bytes = cipher_suite.encrypt(string_to_encrypt.encode())
-    return encrypted_bytes.decode()
+    return self.get_cipher().encrypt(string_to_encrypt)
   
-  def decrypt_str(self, string_to_decrypt: str) -> str:
-    cipher_suite = Fernet(self.encryption_key)
-    decrypted_bytes = cipher_suite.decrypt(string_to_decrypt.encode())
-    return decrypted_bytes.decode()
+  def decrypt_str(self, string_to_decrypt: str) -> Union[str, None]:
+    return self.get_cipher().decrypt(string_to_decrypt)
+
+  def get_cipher(self):
+    if self.cipher is None:
+      # Imported here so that agents not using encryption never load cryptography
+      from network_cipher import NetworkCipher
+      # Keys listed in OLD_IP_ENCRYPTION_KEYS are only used to decrypt, so that records survive a key rotation
+      self.cipher = NetworkCipher([self.encryption_key] + self.CONFIG.get('OLD_IP_ENCRYPTION_KEYS', []))
+    return self.cipher
 
-  def get_network(self):
+  def get_network(self) -> DeviceRegistry:
     self.network_has_been_given = True
-    return self.network
+    return self.devices
   
   def get_current_ip(self):
     return self.last_known_ip
 
+  def get_state(self) -> tuple:
+    """Changes whenever our IP or the network changes, see UpdateScheduler."""
+    return (self.last_known_ip, self.devices.revision)
+
+
 
+def is_unknown_request(response: dict) -> bool:
+  """True if the backend answered that it doesn't know the requestType (older deployments), see request_gas()."""
+  return response.get('status') == 400 and str(response.get('message', '')).startswith('Unknown requestType')
 
 def is_valid_url(url):
     try:
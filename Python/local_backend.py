@@ -0,0 +1,269 @@
+'''
+    Self-hosted stand-in for the GAS web app (GAS/functions.js), speaking the same JSON protocol:
+    POST {authCode, serviceName, requestType, ip, ...} and get back {status, message, value}.
+
+        python -m local_backend --authcode <GAS_AUTHCODE> --port 8080 --db netanchor.db
+
+    then set GAS_SCRIPT_URL to http://<host>:8080/ in config.json.
+    Data is kept in SQLite, with the latest IP of every label also indexed in memory, so that
+    updates and lookups don't scan the whole history like the Sheet-based backend has to.
+'''
+import argparse
+import base64
+from collections import OrderedDict
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import sqlite3
+import threading
+import time
+from typing import Union
+
+
+
+COMPRESSION_MIN_SIZE = 1024 # network responses shorter than this (json characters) are never compressed
+
+
+class Store:
+  """SQLite storage: the IP history of every label plus an index of the latest IP of each one."""
+
+  def __init__(self, path: str = ':memory:', max_ip_logs_for_every_service: int = 5):
+    self.max_ip_logs_for_every_service = max_ip_logs_for_every_service
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self.connection:
+      self.connection.executescript('''
+        CREATE TABLE IF NOT EXISTS ip_history (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          timestamp INTEGER NOT NULL,
+          service_name TEXT NOT NULL,
+          ip TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ip_history_service_name ON ip_history (service_name, id);
+        CREATE TABLE IF NOT EXISTS latest_ip (
+          service_name TEXT PRIMARY KEY,
+          ip TEXT NOT NULL,
+          timestamp INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS heartbeat (
+          service_name TEXT PRIMARY KEY,
+          timestamp INTEGER NOT NULL
+        );
+      ''')
+
+  def get_latest_ips(self) -> dict:
+    with self._lock:
+      return dict(self.connection.execute('SELECT service_name, ip FROM latest_ip ORDER BY rowid'))
+
+  def append_ip(self, service_name: str, ip: str) -> None:
+    """Logs a new ip for service_name, dropping its oldest ones beyond max_ip_logs_for_every_service."""
+    timestamp = int(time.time() * 1000)
+    with self._lock, self.connection:
+      self.connection.execute('INSERT INTO ip_history (timestamp, service_name, ip) VALUES (?, ?, ?)', (timestamp, service_name, ip))
+      self.connection.execute('INSERT OR REPLACE INTO latest_ip (service_name, ip, timestamp) VALUES (?, ?, ?)', (service_name, ip, timestamp))
+      # Only this service's rows are touched, through the (service_name, id) index
+      self.connection.execute('''
+        DELETE FROM ip_history WHERE service_name = ? AND id NOT IN (
+          SELECT id FROM ip_history WHERE service_name = ? ORDER BY id DESC LIMIT ?
+        )''', (service_name, service_name, self.max_ip_logs_for_every_service))
+
+  def append_ips(self, updates: list) -> None:
+    """Same as append_ip() for many [service_name, ip] at once, in a single transaction."""
+    timestamp = int(time.time() * 1000)
+    with self._lock, self.connection:
+      self.connection.executemany('INSERT INTO ip_history (timestamp, service_name, ip) VALUES (?, ?, ?)', [(timestamp, service_name, ip) for service_name, ip in updates])
+      self.connection.executemany('INSERT OR REPLACE INTO latest_ip (service_name, ip, timestamp) VALUES (?, ?, ?)', [(service_name, ip, timestamp) for service_name, ip in updates])
+      self.connection.executemany('''
+        DELETE FROM ip_history WHERE service_name = ? AND id NOT IN (
+          SELECT id FROM ip_history WHERE service_name = ? ORDER BY id DESC LIMIT ?
+        )''', [(service_name, service_name, self.max_ip_logs_for_every_service) for service_name in {service_name for service_name, _ in updates}])
+
+  def record_heartbeat(self, service_name: str) -> None:
+    with self._lock, self.connection:
+      self.connection.execute('INSERT OR REPLACE INTO heartbeat (service_name, timestamp) VALUES (?, ?)', (service_name, int(time.time() * 1000)))
+
+  def close(self):
+    self.connection.close()
+
+
+class LocalBackend:
+  """Handles the doPost requests of GAS/functions.js against a Store.
+
+  The latest IP of every label is kept in memory, along with the network version (a hash of its
+  content, like on GAS) and snapshots of the last few versions to answer with deltas.
+  """
+
+  def __init__(self, store: Store, auth_code: str, max_snapshots: int = 32):
+    self.store = store
+    self.auth_code = auth_code
+    self.network = store.get_latest_ips() # label -> ip
+    self.snapshots = OrderedDict() # version -> network
+    self.max_snapshots = max_snapshots
+    self._lock = threading.Lock()
+    self.version = None
+    self.save_snapshot()
+
+  def handle(self, contents: dict) -> dict:
+    if contents.get('authCode') != self.auth_code:
+      return create_response(401, 'INVALID AUTHCODE')
+
+    service_name = contents.get('serviceName')
+    request_type = contents.get('requestType')
+
+    if request_type == 'UPDATE_IP':
+      self.append_ip(service_name, contents.get('ip'))
+      return create_response(200, f"Logged new ip for service {service_name}: {contents.get('ip')}", 'OK')
+
+    if request_type == 'REQUEST_IP':
+      last_ip = self.network.get(service_name)
+      return create_response(200, f'Last known ip for service {service_name}: {last_ip}', last_ip)
+
+    if request_type == 'REQUEST_NETWORK':
+      return create_response(200, 'Currently known network', self.build_network_response(contents))
+
+    if request_type == 'REPORT_AND_FETCH':
+      ip = contents.get('ip')
+      if ip and ip != self.network.get(service_name):
+        self.append_ip(service_name, ip)
+        message = f'Logged new ip for service {service_name}: {ip}'
+      elif ip:
+        message = f'Ip unchanged for service {service_name}'
+      elif contents.get('heartbeat'):
+        self.store.record_heartbeat(service_name)
+        message = f'Heartbeat recorded for service {service_name}'
+      else:
+        message = f'No ip to record for service {service_name}'
+      return create_response(200, message, self.build_network_response(contents))
+
+    if request_type == 'UPDATE_IPS':
+      # Gateway agents report many services at once: only the ips that changed are recorded
+      updates = [[label, ip] for label, ip in contents.get('updates') or [] if ip and ip != self.network.get(label)]
+      self.append_ips(updates)
+      if contents.get('heartbeat'):
+        self.store.record_heartbeat(service_name)
+      return create_response(200, f'Logged {len(updates)} new ips from service {service_name}', self.build_network_response(contents))
+
+    return create_response(400, f'Unknown requestType: {request_type}')
+
+  def append_ip(self, service_name: str, ip: str) -> None:
+    with self._lock:
+      self.store.append_ip(service_name, ip)
+      if self.network.get(service_name) != ip:
+        self.network[service_name] = ip
+        self.save_snapshot()
+
+  def append_ips(self, updates: list) -> None:
+    if len(updates) == 0:
+      return
+    with self._lock:
+      self.store.append_ips(updates)
+      self.network.update((label, ip) for label, ip in updates)
+      self.save_snapshot()
+
+  def save_snapshot(self) -> None:
+    self.version = compute_network_version(self.network)
+    self.snapshots[self.version] = dict(self.network)
+    self.snapshots.move_to_end(self.version)
+    while len(self.snapshots) > self.max_snapshots:
+      self.snapshots.popitem(last=False)
+
+  def build_network_response(self, contents: dict) -> Union[list, dict]:
+    """Same as buildNetworkResponse() in GAS/functions.js, against the networkVersion sent by the client,
+    compressed if the client asked for it like compressNetworkResponse()."""
+    return compress_network_response(self.build_uncompressed_network_response(contents), contents.get('compression'))
+
+  def build_uncompressed_network_response(self, contents: dict) -> Union[list, dict]:
+    known_version = contents.get('networkVersion')
+    with self._lock:
+      network = dict(self.network)
+      version = self.version
+      known_network = self.snapshots.get(known_version) if isinstance(known_version, str) else None
+
+    if 'networkVersion' not in contents: # older clients
+      return [[label, ip] for label, ip in network.items()]
+    if known_version == version:
+      return {'version': version, 'unchanged': True}
+    if known_network is None:
+      return {'version': version, 'network': [[label, ip] for label, ip in network.items()]}
+
+    return {
+      'version': version,
+      'added': [[label, ip] for label, ip in network.items() if label not in known_network],
+      'changed': [[label, ip] for label, ip in network.items() if label in known_network and known_network[label] != ip],
+      'removed': [label for label in known_network if label not in network],
+    }
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+  backend = None # set by create_server()
+
+  def do_POST(self):
+    try:
+      contents = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+      response = self.backend.handle(contents)
+    except Exception as e:
+      response = create_response(500, f'Server error: {e}')
+    self.send_json(response)
+
+  def do_GET(self):
+    # GAS requires doGet() but doesn't use it either
+    self.send_json(create_response(200, 'NetAnchor local backend'))
+
+  def send_json(self, response: dict):
+    body = json.dumps(response).encode()
+    # Like GAS, the status lives in the body and the HTTP status is always 200
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+
+def create_response(status: int, message: str, value=None) -> dict:
+  return {'status': status, 'message': message, 'value': value}
+
+def compress_network_response(value: Union[list, dict], compression: Union[str, None]) -> Union[list, dict]:
+  if compression != 'gzip':
+    return value
+  contents = json.dumps(value)
+  if len(contents) < COMPRESSION_MIN_SIZE:
+    return value
+  return {'compressed': 'gzip', 'data': base64.b64encode(gzip.compress(contents.encode())).decode()}
+
+def compute_network_version(network: dict) -> str:
+  entries = [[label, network[label]] for label in sorted(network)]
+  return hashlib.md5(json.dumps(entries, separators=(',', ':'), ensure_ascii=False).encode()).hexdigest()
+
+def create_server(backend: LocalBackend, host: str = '127.0.0.1', port: int = 8080) -> ThreadingHTTPServer:
+  handler = type('BoundRequestHandler', (RequestHandler,), {'backend': backend})
+  return ThreadingHTTPServer((host, port), handler)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='local_backend', description='Self-hosted NetAnchor backend')
+  parser.add_argument('--authcode', required=True, help='must match GAS_AUTHCODE in config.json')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--db', default='netanchor.db', help='SQLite database path, ":memory:" for a throwaway one')
+  parser.add_argument('--max-ip-logs', type=int, default=5, help='IPs kept for every label (MAX_IP_LOGS_FOR_EVERY_SERVICE)')
+  args = parser.parse_args(argv)
+
+  backend = LocalBackend(Store(args.db, args.max_ip_logs), args.authcode)
+  server = create_server(backend, args.host, args.port)
+  print(f'NetAnchor local backend listening on http://{args.host}:{server.server_port}/')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    backend.store.close()
+
+
+
+if __name__ == '__main__':
+  main()
@@ -1,18 +1,33 @@
+from collections import deque
 from datetime import datetime
+from itertools import count, islice
 import json
-import time
+import threading
 
 class Logger:
-    def __init__(self):
-        self.logs = []
+    def __init__(self, capacity: int = 1000, stream=None, echo: bool = True):
+        # Newest entries are kept on the left, so the oldest fall off the right end once full
+        self.logs = deque(maxlen=capacity)
+        self._sequence = count()
+        self._lock = threading.Lock() # log() is called from the update worker threads too
+        self.stream = stream # where log lines are echoed, stdout if None
+        self.echo = echo
 
     def log(self, *args):
         message = ' '.join(str(arg) if not isinstance(arg, dict) else json.dumps(arg) for arg in args)
         date = datetime.now()
-        time.sleep(1/10) # to allow for correct ordering of the logs
-        self.logs.append((date, message))
-        self.logs.sort(reverse=True)
-        print('LOGGER: ', message)
+        with self._lock:
+            # The sequence number keeps entries ordered even when they share the same timestamp
+            self.logs.appendleft((next(self._sequence), date, message))
+        if self.echo:
+            print('LOGGER: ', message, file=self.stream)
 
-    def get_logs_as_strings(self) -> list[str]:
-        return [f"{log[0].strftime('%Y-%m-%d %H:%M:%S')} - {log[1]}" for log in self.logs]
\ No newline at end of file
+    def get_logs_as_strings(self, limit: int = None) -> list[str]:
+        """Returns the logs as formatted strings, newest first.
+
+        Args:
+          limit (int, optional): only format the newest `limit` entries. Defaults to the whole buffer.
+        """
+        with self._lock:
+            logs = list(islice(self.logs, limit))
+        return [f"{log[1].strftime('%Y-%m-%d %H:%M:%S')} - {log[2]}" for log in logs]
@@ -1,17 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import os
 import random
-import schedule
 import string
-import tkinter.font as tkFont
-import threading
 import PySimpleGUI as sg
 import webbrowser
 
+from config import load_config, save_config
 from images import cc_image, github_image, donate_image, logo_image
 from ip_manager import IPManager
 from logger import Logger
+from network_view import NetworkView
+from scheduler import NetworkMonitor, UpdateScheduler
+from update_engine import UpdateEngine
 
 
 
@@ -21,62 +22,16 @@ from logger import Logger
 #
 #
 
-def load_config(CONFIG_FILE_PATH) -> str:
-    if os.path.exists(CONFIG_FILE_PATH):
-        LOGGER.log('Config file exists.')
-    else:
-        LOGGER.log('Config file does not exists. Loading default config')
-        CONFIG = {
-            "GAS_SCRIPT_URL": "",
-            "GAS_AUTHCODE": "",
-            "IP_UPDATE_INTERVAL": 15,
-            "MACHINE_NAME": "NetAnchored Device",
-            "IP_SERVICE": "https://api.ipify.org",
-            "USE_ENCRYPTED_DATABASE": False,
-            "IP_ENCRYPTION_KEY": "",
-            "MAX_UI_LOGS": 10
-        }
-        return CONFIG
-        # raise Exception('Config file not found. Unable to run program.')
-
-
-    LOGGER.log('Loading config...')
-    with open(CONFIG_FILE_PATH, "r") as file:
-        CONFIG = json.load(file)
-    LOGGER.log('Config loaded.')
-    return CONFIG
-
-def save_config(config, CONFIG_FILE_PATH):
-    LOGGER.log('Saving config...')
-    with open(CONFIG_FILE_PATH, "w") as file:
-        json.dump(config, file, indent=4)
-    LOGGER.log('Config saved.')
-
 def create_main_window_layout():
-    # Text version    
-    # Create a font with the same family and size but bold style
-    default_font = sg.DEFAULT_FONT[0]
-    default_size = sg.DEFAULT_FONT[1]
-    bold_font = tkFont.Font(family=default_font, size=default_size, weight="bold", slant="italic")
-
-    # Create network list, bold our current IP and LABEL
-    network_frame_rows = []
-    for i, entry in enumerate(IP_MANAGER.get_network()):
-        network_frame_rows.append([sg.Text(entry[0], key=f'-CLIENT_{i}_LABEL-', expand_x=True, font=(bold_font if entry[1] == IP_MANAGER.get_current_ip() else None)), sg.Text(
-            entry[1], key=f'-CLIENT_{i}_IP-', font=(bold_font if entry[1] == IP_MANAGER.get_current_ip() else None)), sg.Button("Copy", key=f'-BUTTON_COPY_IP_{i}-')])
-
-    # ListBox version
-    # network_frame_rows = [[sg.Listbox([f'{entry[0]}: {entry[1]}' for entry in network], key='-CLIENTS-', enable_events=True, size=(50, 10))]]
-
-    network_frame = sg.Frame(
-        'Network', network_frame_rows if len(network_frame_rows) > 0 else [[sg.Text('No data')]], key='-NETWORK_FRAME-', expand_x=True)
+    # Create network table, highlighting our machine
+    network_frame = NETWORK_VIEW.create_frame(IP_MANAGER.get_network(), IP_MANAGER.get_current_ip())
 
     upper_row_left_column = sg.Column([
         [network_frame],
         [sg.VPush()]
     ], expand_y=True, expand_x=True)
 
-    log_rows = [row for row in LOGGER.get_logs_as_strings()]
+    log_rows = LOGGER.get_logs_as_strings(CONFIG['MAX_UI_LOGS'])
     log_frame_rows = [[sg.Listbox(log_rows, size=(100, CONFIG['MAX_UI_LOGS']), key='-LOGS_LISTBOX-',
                                   disabled=False, no_scrollbar=True, expand_x=True)]]
     log_frame = sg.Frame('Log', log_frame_rows, expand_x=True)
@@ -97,7 +52,7 @@ def create_main_window_layout():
     upper_row = [upper_row_left_column, upper_row_right_column]
     lower_row = [log_frame]
 
-    status_bar = [sg.Text(f"{CONFIG['MACHINE_NAME']}: {IP_MANAGER.get_current_ip()}", key='-CURRENT_IP-'), sg.Push(), sg.Text(f"Time to next update: Unknown", key='-TIMER-')]
+    status_bar = [sg.Text(get_status_text(), key='-CURRENT_IP-'), sg.Push(), sg.Text(get_next_update_text(), key='-TIMER-')]
 
     layout = [
         upper_row,
@@ -108,11 +63,31 @@ def create_main_window_layout():
 
     return layout
 
+def get_status_text() -> str:
+    status = f"{CONFIG['MACHINE_NAME']}: {IP_MANAGER.get_current_ip()}"
+    if IP_MANAGER.is_network_cached():
+        status += f" (cached network from {IP_MANAGER.network_fetched_at.strftime('%Y-%m-%d %H:%M')}, refreshing...)"
+    return status
+
+def get_next_update_text() -> str:
+    next_update = datetime.now() + timedelta(seconds=SCHEDULER.get_time_to_next_run())
+    return f"Next update at {next_update.strftime('%H:%M:%S')}"
+
+def refresh_main_window():
+    '''
+        Updates the network frame and the status bar in place with the latest data from IP_MANAGER
+    '''
+    with IP_MANAGER.metrics.timer('ui_refresh'):
+        MAIN_WINDOW.finalize()
+        devices = IP_MANAGER.get_network()
+        NETWORK_VIEW.update(MAIN_WINDOW, devices, devices.take_changed_labels(), IP_MANAGER.get_current_ip())
+        NETWORK_VIEW.update_status(MAIN_WINDOW, get_status_text())
+
 def get_main_window():
     global PROGRAM_TITLE
     print('getting main window')
 
-    window = sg.Window(f"{PROGRAM_TITLE}", create_main_window_layout(), icon=logo_image, resizable=False)
+    window = sg.Window(f"{PROGRAM_TITLE}", create_main_window_layout(), icon=logo_image, resizable=True)
     return window
 
 def splash_window():
@@ -155,9 +130,10 @@ def open_config_window() -> bool:
         CONFIG['USE_ENCRYPTED_DATABASE'] = values['-USE_ENCRYPTED_DATABASE-']
         CONFIG['IP_ENCRYPTION_KEY'] = values['-IP_ENCRYPTION_KEY-']
         CONFIG['MAX_UI_LOGS'] = int(values['-MAX_UI_LOGS-'])
+        SCHEDULER.min_interval, SCHEDULER.max_interval = get_update_intervals()
 
-        save_config(CONFIG, CONFIG_FILE_PATH)
-        IP_MANAGER = IPManager(CONFIG, LOGGER, IP_MANAGER.get_network(), IP_MANAGER.get_current_ip())
+        save_config(CONFIG, CONFIG_FILE_PATH, LOGGER)
+        IP_MANAGER = IPManager(CONFIG, LOGGER, IP_MANAGER.devices, IP_MANAGER.get_current_ip(), IP_MANAGER.transport, NETWORK_CACHE_PATH, IP_MANAGER.metrics)
         window.close()
         return True
     else:
@@ -168,19 +144,32 @@ def generate_random_authcode() -> str:
     chars = string.ascii_letters + string.digits
     return ''.join(random.choice(chars) for _ in range(20))
 
-def update_ip_manager():
+def get_update_intervals() -> tuple:
     '''
-        This is to allow the scheduled task to always call the current instance of IP_MANAGER
+        (min, max) seconds between updates for SCHEDULER: IP_UPDATE_INTERVAL is the longest it waits on a quiet network
     '''
-    global MAIN_WINDOW
-    global IP_MANAGER
+    max_interval = CONFIG['IP_UPDATE_INTERVAL'] * 60
+    return min(CONFIG.get('MIN_UPDATE_INTERVAL', 1) * 60, max_interval), max_interval
 
-    IP_MANAGER.update()
-    MAIN_WINDOW.close()
-    MAIN_WINDOW = get_main_window()
+def update_ip_manager() -> tuple:
+    '''
+        This is to allow the scheduled task to always call the current instance of IP_MANAGER.
+        Runs on the SCHEDULER thread and waits for the update to finish on UPDATE_ENGINE, returning (success, changed).
+    '''
+    ip_manager = IP_MANAGER
+    state = ip_manager.get_state()
+    success = UPDATE_ENGINE.request_update(ip_manager).result()
+    return success, ip_manager.get_state() != state
+
+def on_scheduled():
+    # Called from the scheduler thread, like on_update_done()
+    if MAIN_WINDOW is not None:
+        MAIN_WINDOW.write_event_value('-SCHEDULE_CHANGED-', None)
 
-def mt_ip_manager_update(IP_MANAGER):
-    IP_MANAGER.update()
+def on_update_done():
+    # Called from the engine thread: the window can only be touched from the GUI thread, so let the event loop know we're done
+    if MAIN_WINDOW is not None:
+        MAIN_WINDOW.write_event_value('-NETWORK_UPDATE_DONE-', None)
 
 def main():
     global MAIN_WINDOW
@@ -201,27 +190,21 @@ def main():
 
     while True:
         if first_loop == True:
-            splash_w = splash_window()
-            # IP_MANAGER.update()
-            splash_w.close()
+            # With a cached network there's already something to show, so it's refreshed in the background
+            if not IP_MANAGER.load_cached_network():
+                splash_w = splash_window()
+                splash_w.close()
             MAIN_WINDOW = get_main_window()
-            thread = threading.Thread(target=mt_ip_manager_update, args=(IP_MANAGER,))
-            thread.start()
+            # The first update runs right away
+            SCHEDULER.start(update_ip_manager, on_scheduled)
             first_loop = False
 
-        event, values = MAIN_WINDOW.read(timeout=500) # ! this is a blocking function until an event is triggered. Set a timeout (ms)
+        # No timeout: updates are scheduled on their own thread and report back with events, so an idle window never wakes up
+        event, values = MAIN_WINDOW.read() # ! this is a blocking function until an event is triggered
 
         # if event != '__TIMEOUT__':
         #     LOGGER.log('Event: ', event)
 
-        schedule.run_pending()
-
-        # Update timer till next network update
-        time_to_next_update = schedule.next_run() - datetime.now()
-        m, s = divmod(time_to_next_update.total_seconds(), 60)
-        MAIN_WINDOW.finalize()
-        MAIN_WINDOW['-TIMER-'].update(value=f"Time to next update: {int(m):02}:{int(s):02}")
-
         # Exit the program when the window is closed
         if event == sg.WIN_CLOSED or event == None:
             break
@@ -241,28 +224,37 @@ def main():
             MAIN_WINDOW = get_main_window()
         elif event == '-BUTTON_FORCE_NETWORK_UPDATE-':
             MAIN_WINDOW['-BUTTON_FORCE_NETWORK_UPDATE-'].update('Updating...', disabled=True)
-            thread = threading.Thread(target=mt_ip_manager_update, args=(IP_MANAGER,))
-            thread.start()
-            # Optionally, you can wait for the thread to complete using join()
-            # thread.join()
-        elif type(event) == str and event.startswith("-BUTTON_COPY_IP_"):
-            index = int(event.split("_")[3].replace('-', ''))
-            client_ip = MAIN_WINDOW[f'-CLIENT_{index}_IP-'].get()
-            sg.clipboard_set(client_ip)
-            LOGGER.log(f"IP '{client_ip}' copied to clipboard!")
+            SCHEDULER.trigger()
+        elif event == '-NETWORK_UPDATE_DONE-':
+            MAIN_WINDOW['-BUTTON_FORCE_NETWORK_UPDATE-'].update('Update now', disabled=False)
+            refresh_main_window()
+        elif event == '-SCHEDULE_CHANGED-':
+            MAIN_WINDOW['-TIMER-'].update(value=get_next_update_text())
+        elif event == '-NETWORK_FILTER-':
+            NETWORK_VIEW.set_filter(MAIN_WINDOW, IP_MANAGER.devices, values['-NETWORK_FILTER-'])
+        elif type(event) == tuple and event[0] == '-NETWORK_TABLE-':
+            row, column = event[2]
+            if row == -1 and column is not None: # click on a heading
+                NETWORK_VIEW.sort_by(MAIN_WINDOW, IP_MANAGER.devices, column)
+        elif event == '-NETWORK_TABLE-' and len(values['-NETWORK_TABLE-']) > 0:
+            device = IP_MANAGER.devices.get(NETWORK_VIEW.get_label(values['-NETWORK_TABLE-'][0]))
+            if device is not None:
+                sg.clipboard_set(device.ip)
+                LOGGER.log(f"IP '{device.ip}' copied to clipboard!")
 
         # Update logs listbox and refresh window no matter the event
         MAIN_WINDOW.finalize()
-        log_rows = [row for row in LOGGER.get_logs_as_strings()]
+        log_rows = LOGGER.get_logs_as_strings(CONFIG['MAX_UI_LOGS'])
         MAIN_WINDOW['-LOGS_LISTBOX-'].update(values=log_rows)
         MAIN_WINDOW.refresh()
 
         # See dev_readme.md for an explanation about this # TODO
         if not IP_MANAGER.has_network_been_given():
-            MAIN_WINDOW.close()
-            MAIN_WINDOW = get_main_window()
+            refresh_main_window()
 
     # Close the window and end the program
+    SCHEDULER.stop()
+    UPDATE_ENGINE.stop()
     MAIN_WINDOW.close()
 
 
@@ -279,18 +271,20 @@ def main():
 VERSION = 'v0.1.0'
 
 CONFIG_FILE_PATH = os.path.join(os.getcwd(), 'config.json')
+NETWORK_CACHE_PATH = os.path.join(os.getcwd(), 'network_cache.json')
 
 LOGGER = Logger()
-CONFIG = load_config(CONFIG_FILE_PATH)
-IP_MANAGER = IPManager(CONFIG, LOGGER)
+CONFIG = load_config(CONFIG_FILE_PATH, LOGGER)
+IP_MANAGER = IPManager(CONFIG, LOGGER, cache_path=NETWORK_CACHE_PATH)
 MAIN_WINDOW = None # Main window is in the global scope so that it's easier to refresh it when a scheduled task runs
+NETWORK_VIEW = NetworkView()
+UPDATE_ENGINE = UpdateEngine(LOGGER, on_update_done)
+# Updates run when the local network changes, and otherwise back off from MIN_UPDATE_INTERVAL to IP_UPDATE_INTERVAL
+SCHEDULER = UpdateScheduler(*get_update_intervals(), monitor=NetworkMonitor(logger=LOGGER), logger=LOGGER)
 
 LOGGER.log('Program started')
 PROGRAM_TITLE = f"NetAnchor - {VERSION}"
 
-# Schedule the updating task
-schedule.every(CONFIG['IP_UPDATE_INTERVAL']).minutes.do(update_ip_manager)
-
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+
+# Upper bounds (seconds) of the duration histogram buckets, +Inf is implicit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+  def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value: float):
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+        break
+    else:
+      self.counts[-1] += 1
+    self.sum += value
+    self.count += 1
+
+  def get_cumulative_counts(self) -> list[int]:
+    cumulative, total = [], 0
+    for count in self.counts:
+      total += count
+      cumulative.append(total)
+    return cumulative
+
+
+class Metrics:
+  """Timing and outcome of every phase of an update, per endpoint.
+
+  Phases report through observe() (or the timer() context manager): each observation feeds a
+  duration histogram and a success/failure counter keyed by (phase, endpoint), then goes to the
+  hooks added with add_hook(), e.g. to forward it to another monitoring system.
+  Gauges hold single values like the time of the last successful sync and the network size.
+  Everything can be exported as Prometheus text or JSON.
+  """
+
+  def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.histograms = {} # (phase, endpoint) -> Histogram
+    self.counters = {} # (phase, endpoint, result) -> int
+    self.gauges = {} # name -> float
+    self.hooks = []
+    self._lock = threading.Lock()
+
+  def add_hook(self, hook: Callable[[str, str, float, bool], None]):
+    """hook(phase, endpoint, duration, success) is called after every observation."""
+    self.hooks.append(hook)
+
+  def observe(self, phase: str, duration: float, success: bool, endpoint: str = '') -> None:
+    with self._lock:
+      if (phase, endpoint) not in self.histograms:
+        self.histograms[(phase, endpoint)] = Histogram(self.buckets)
+      self.histograms[(phase, endpoint)].observe(duration)
+      key = (phase, endpoint, 'success' if success else 'failure')
+      self.counters[key] = self.counters.get(key, 0) + 1
+
+    for hook in self.hooks:
+      try:
+        hook(phase, endpoint, duration, success)
+      except Exception:
+        pass # a broken hook must never break an update
+
+  @contextmanager
+  def timer(self, phase: str, endpoint: str = ''):
+    """Times the block, which can set result['success'] = False; exceptions count as failures."""
+    result = {'success': True}
+    start = time.monotonic()
+    try:
+      yield result
+    except Exception:
+      result['success'] = False
+      raise
+    finally:
+      self.observe(phase, time.monotonic() - start, result['success'], endpoint)
+
+  def set_gauge(self, name: str, value: float) -> None:
+    with self._lock:
+      self.gauges[name] = value
+
+  def to_dict(self) -> dict:
+    with self._lock:
+      return {
+        'phases': [
+          {
+            'phase': phase,
+            'endpoint': endpoint,
+            'success': self.counters.get((phase, endpoint, 'success'), 0),
+            'failure': self.counters.get((phase, endpoint, 'failure'), 0),
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], histogram.get_cumulative_counts())),
+          }
+          for (phase, endpoint), histogram in self.histograms.items()
+        ],
+        'gauges': dict(self.gauges),
+      }
+
+  def to_prometheus(self) -> str:
+    with self._lock:
+      lines = ['# TYPE netanchor_phase_duration_seconds histogram']
+      for (phase, endpoint), histogram in self.histograms.items():
+        labels = f'phase="{escape_label(phase)}",endpoint="{escape_label(endpoint)}"'
+        for bound, count in zip([str(bound) for bound in self.buckets] + ['+Inf'], histogram.get_cumulative_counts()):
+          lines.append(f'netanchor_phase_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'netanchor_phase_duration_seconds_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'netanchor_phase_duration_seconds_count{{{labels}}} {histogram.count}')
+
+      lines.append('# TYPE netanchor_phase_total counter')
+      for (phase, endpoint, result), count in self.counters.items():
+        lines.append(f'netanchor_phase_total{{phase="{escape_label(phase)}",endpoint="{escape_label(endpoint)}",result="{result}"}} {count}')
+
+      for name, value in self.gauges.items():
+        lines.append(f'# TYPE netanchor_{name} gauge')
+        lines.append(f'netanchor_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+  def write_file(self, path: str) -> None:
+    """Writes the metrics to path, as JSON if it ends with .json and as Prometheus text otherwise."""
+    contents = json.dumps(self.to_dict(), indent=2) if path.endswith('.json') else self.to_prometheus()
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as file:
+      file.write(contents)
+    os.replace(temporary_path, path) # so that scrapers never read a half written file
+
+
+
+def escape_label(value: str) -> str:
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,144 @@
+'''
+    Headless entry point, for servers without a display and for scripts:
+
+        python -m netanchor agent          keeps reporting our IP and fetching the network, see UpdateScheduler
+        python -m netanchor agent --once   reports and fetches once, then prints the network as JSON
+        python -m netanchor list           fetches the network and prints it as JSON
+
+    When GATEWAY_DEVICES is set the agent runs in gateway mode, reporting the IPs of all those devices (see gateway.py).
+
+    The agent can export its metrics (see metrics.py) with --metrics-file (Prometheus text, or JSON if the name
+    ends with .json) and/or --metrics-port (serves /metrics as Prometheus text and /metrics.json).
+
+    Nothing GUI related (PySimpleGUI, tkinter, images) is imported here, so this starts much faster than main.py
+    and can be run from systemd or cron.
+'''
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import signal
+import sys
+import threading
+
+from config import load_config, save_config
+from gateway import Gateway
+from ip_manager import IPManager
+from logger import Logger
+from metrics import Metrics
+from scheduler import NetworkMonitor, UpdateScheduler
+
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='netanchor', description='NetAnchor headless agent')
+    parser.add_argument('--config', default=os.path.join(os.getcwd(), 'config.json'), help='path of config.json (default: ./config.json)')
+    parser.add_argument('-q', '--quiet', action='store_true', help="don't print logs to stderr")
+    parser.add_argument('--metrics-file', help='write metrics here after every update (.json for JSON, Prometheus text otherwise)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    agent_parser = subparsers.add_parser('agent', help='report our IP and fetch the network periodically')
+    agent_parser.add_argument('--once', action='store_true', help='run a single update, print the network and exit')
+    agent_parser.add_argument('--interval', type=float, default=None, help='longest wait between updates in minutes (default: IP_UPDATE_INTERVAL)')
+    agent_parser.add_argument('--min-interval', type=float, default=None, help='shortest wait between updates in minutes (default: MIN_UPDATE_INTERVAL or 1)')
+    agent_parser.add_argument('--metrics-port', type=int, default=None, help='serve metrics over HTTP on this port')
+
+    subparsers.add_parser('list', help='fetch the network and print it as JSON')
+    return parser.parse_args(argv)
+
+def print_network(ip_manager: IPManager):
+    network = [{'label': device.label, 'ip': device.ip} for device in ip_manager.get_network()]
+    print(json.dumps(network, indent=2))
+
+def write_metrics(metrics: Metrics, path: str, logger: Logger):
+    if path is None:
+        return
+    try:
+        metrics.write_file(path)
+    except OSError as e:
+        logger.log(f'ERROR: unable to write metrics: {e}')
+
+def serve_metrics(metrics: Metrics, port: int) -> ThreadingHTTPServer:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.to_prometheus().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(metrics.to_dict()).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    return server
+
+def run_agent(updater, interval_minutes: float, min_interval_minutes: float, logger: Logger, metrics_file: str = None):
+    '''
+        Runs updater.update() right away, whenever the local network changes and otherwise backing off from
+        min_interval_minutes to interval_minutes (see UpdateScheduler). The updater is an IPManager, or a Gateway in gateway mode
+    '''
+    scheduler = UpdateScheduler(min(min_interval_minutes, interval_minutes) * 60, interval_minutes * 60, monitor=NetworkMonitor(logger=logger), logger=logger)
+
+    def update() -> tuple:
+        state = updater.get_state()
+        success = updater.update()
+        write_metrics(updater.metrics, metrics_file, logger)
+        return success, updater.get_state() != state
+
+    logger.log(f'Agent started, updating every {min_interval_minutes} to {interval_minutes} minutes')
+    scheduler.run(update)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    # Logs go to stderr so that stdout only carries the JSON output
+    logger = Logger(stream=sys.stderr, echo=not args.quiet)
+    config = load_config(args.config, logger)
+    cache_path = os.path.join(os.path.dirname(os.path.abspath(args.config)), 'network_cache.json')
+    ip_manager = IPManager(config, logger, cache_path=cache_path)
+
+    if args.command == 'list':
+        ip_manager.fetch_network()
+        write_metrics(ip_manager.metrics, args.metrics_file, logger)
+        print_network(ip_manager)
+        return 0 if ip_manager.network_fetched_at is not None else 1
+
+    # if a new key is generated, we write it to the config.json
+    if config['IP_ENCRYPTION_KEY'] == '':
+        config['IP_ENCRYPTION_KEY'] = ip_manager.encryption_key.decode()
+        save_config(config, args.config, logger)
+
+    updater = ip_manager
+    if config.get('GATEWAY_DEVICES'):
+        updater = Gateway(ip_manager, config['GATEWAY_DEVICES'])
+        logger.log(f"Gateway mode: reporting {len(config['GATEWAY_DEVICES'])} devices")
+
+    if args.once:
+        updater.update()
+        write_metrics(ip_manager.metrics, args.metrics_file, logger)
+        print_network(ip_manager)
+        return 0 if ip_manager.network_fetched_at is not None else 1
+
+    # systemd stops services with SIGTERM: exit as cleanly as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.metrics_port is not None:
+        serve_metrics(ip_manager.metrics, args.metrics_port)
+        logger.log(f'Serving metrics on port {args.metrics_port}')
+    try:
+        run_agent(updater, args.interval or config['IP_UPDATE_INTERVAL'], args.min_interval or config.get('MIN_UPDATE_INTERVAL', 1), logger, args.metrics_file)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+from datetime import datetime
+import json
+import os
+from typing import Union
+
+
+class NetworkCache:
+  """Keeps the last good network on disk, so that it can be shown right away at startup.
+
+  The cache is a small json file holding the network, our last known IP, the network version
+  (with the labels of the label ids GAS knows our devices by) and the time of the fetch. When a cipher is given the whole file is encrypted with it.
+  """
+
+  def __init__(self, path: str, cipher=None, logger=None):
+    self.path = path
+    self.cipher = cipher
+    self.logger = logger
+
+  def save(self, network: list, current_ip: Union[str, None], network_version: Union[str, None], labels_by_service_name: Union[dict, None] = None) -> None:
+    contents = json.dumps({
+      'fetched_at': datetime.now().isoformat(),
+      'current_ip': current_ip,
+      'network_version': network_version,
+      'labels_by_service_name': labels_by_service_name or {},
+      'network': network,
+    })
+    if self.cipher is not None:
+      contents = self.cipher.encrypt(contents)
+
+    # Write to a temporary file first, so that a crash never leaves a truncated cache behind
+    temporary_path = f'{self.path}.tmp'
+    try:
+      with open(temporary_path, 'w') as file:
+        file.write(contents)
+      os.replace(temporary_path, self.path)
+    except OSError as e:
+      self.log(f'ERROR: unable to save network cache: {e}')
+
+  def load(self) -> Union[dict, None]:
+    """Returns the cached {fetched_at, current_ip, network_version, labels_by_service_name, network}, or None if there's no usable cache."""
+    if not os.path.exists(self.path):
+      return None
+
+    try:
+      with open(self.path, 'r') as file:
+        contents = file.read()
+      if self.cipher is not None:
+        contents = self.cipher.decrypt(contents)
+        if contents is None:
+          self.log('Network cache was encrypted with a different key, ignoring it')
+          return None
+      cache = json.loads(contents)
+      cache['fetched_at'] = datetime.fromisoformat(cache['fetched_at'])
+      return cache
+    except (OSError, ValueError, KeyError) as e:
+      self.log(f'ERROR: unable to load network cache: {e}')
+      return None
+
+  def log(self, *args):
+    if self.logger is not None:
+      self.logger.log(*args)
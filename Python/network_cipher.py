@@ -0,0 +1,111 @@
+import base64
+from collections import OrderedDict
+import hashlib
+import hmac
+import ipaddress
+import os
+import threading
+from typing import Union
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+RECORD_PREFIX = 'r2.' # compact records, see encrypt_record()
+LABEL_ID_PREFIX = 'l2.'
+
+
+class NetworkCipher:
+  """Encrypts and decrypts the strings stored in the GAS database.
+
+  The Fernet cipher is built once. With more than one key a MultiFernet is used: it encrypts
+  with the first key and decrypts with any of them, so old records stay readable while keys
+  are rotated. Decrypted tokens are kept in a bounded LRU cache, so records that didn't change
+  since the last fetch cost nothing.
+
+  It also handles compact records (RECORD_FORMAT 2): the label and the IP of a device packed in a
+  single AES-GCM token, stored under a label id that is a keyed hash of the label, so that the
+  backend can still tell devices apart without being able to read their labels.
+  """
+
+  def __init__(self, keys: list, cache_size: int = 4096):
+    ciphers = [Fernet(key) for key in keys]
+    self.cipher = ciphers[0] if len(ciphers) == 1 else MultiFernet(ciphers)
+    # The record and label id keys are derived from the Fernet keys, so there's nothing new to configure
+    raw_keys = [base64.urlsafe_b64decode(key) for key in keys]
+    self.record_ciphers = [AESGCM(derive_key(raw_key, b'netanchor record')) for raw_key in raw_keys]
+    self.label_id_key = derive_key(raw_keys[0], b'netanchor label id')
+    self.cache = OrderedDict() # token -> plaintext
+    self.cache_size = cache_size
+    self._lock = threading.Lock()
+
+  def encrypt(self, string_to_encrypt: str) -> str:
+    return self.cipher.encrypt(string_to_encrypt.encode()).decode()
+
+  def decrypt(self, string_to_decrypt: str) -> Union[str, None]:
+    """Returns the plaintext, or None if the token can't be decrypted with our keys."""
+    return self.get_cached(string_to_decrypt, self.decrypt_token)
+
+  def decrypt_token(self, token: str) -> Union[str, None]:
+    try:
+      return self.cipher.decrypt(token.encode()).decode()
+    except (InvalidToken, UnicodeError):
+      return None
+
+  def get_label_id(self, label: str) -> str:
+    """The name a device is stored under with compact records: always the same for a label and key."""
+    digest = hmac.new(self.label_id_key, label.encode(), hashlib.sha256).digest()[:16]
+    return LABEL_ID_PREFIX + base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+  def encrypt_record(self, label: str, ip: str) -> str:
+    """Packs the IPv4 and the label in a single token: about 60 characters instead of two 100+ characters Fernet tokens."""
+    nonce = os.urandom(12)
+    packed = ipaddress.IPv4Address(ip).packed + label.encode()
+    token = nonce + self.record_ciphers[0].encrypt(nonce, packed, RECORD_PREFIX.encode())
+    return RECORD_PREFIX + base64.urlsafe_b64encode(token).decode().rstrip('=')
+
+  def decrypt_record(self, token: str) -> Union[tuple, None]:
+    """Returns the (label, ip) of a compact record, or None if it can't be decrypted with our keys."""
+    return self.get_cached(token, self.decrypt_record_token)
+
+  def decrypt_record_token(self, token: str) -> Union[tuple, None]:
+    try:
+      data = base64.urlsafe_b64decode(token[len(RECORD_PREFIX):] + '=' * (-len(token) % 4))
+    except ValueError:
+      return None
+    for record_cipher in self.record_ciphers:
+      try:
+        packed = record_cipher.decrypt(data[:12], data[12:], RECORD_PREFIX.encode())
+        return (packed[4:].decode(), str(ipaddress.IPv4Address(packed[:4])))
+      except (InvalidTag, ValueError):
+        continue
+    return None
+
+  def get_cached(self, token: str, decrypt_token) -> Union[str, tuple, None]:
+    with self._lock:
+      if token in self.cache:
+        self.cache.move_to_end(token)
+        return self.cache[token]
+
+    plaintext = decrypt_token(token)
+    if plaintext is None:
+      return None
+
+    with self._lock:
+      self.cache[token] = plaintext
+      if len(self.cache) > self.cache_size:
+        self.cache.popitem(last=False)
+    return plaintext
+
+  def decrypt_many(self, tokens: list[str]) -> list[Union[str, tuple, None]]:
+    """Decrypts Fernet tokens to strings and compact records to (label, ip), None for the ones we can't decrypt."""
+    return [self.decrypt_any(token) for token in tokens]
+
+  def decrypt_any(self, token: str) -> Union[str, tuple, None]:
+    return self.decrypt_record(token) if token.startswith(RECORD_PREFIX) else self.decrypt(token)
+
+
+
+def derive_key(key: bytes, purpose: bytes) -> bytes:
+  return hmac.new(key, purpose, hashlib.sha256).digest()
@@ -0,0 +1,115 @@
+import ipaddress
+from typing import Union
+import PySimpleGUI as sg
+
+from devices import Device, DeviceRegistry
+
+
+
+MAX_SHOWN_DEVICES = 500 # rows given to the table at most, the filter narrows down the others
+TABLE_ROWS = 15 # visible rows, the table scrolls for the others
+
+
+class NetworkView:
+    '''
+        The network frame of the main window: a single table with the devices, a filter on label or IP
+        and sorting by clicking the headings. Selecting a row copies its IP.
+        The table is only refilled when the devices, our IP, the filter or the sorting changed, and it's given
+        MAX_SHOWN_DEVICES rows at most, so large fleets don't make the window slow.
+    '''
+    def __init__(self):
+        self.shown = [] # labels of the table rows, in order
+        self.current_ip = None
+        self.filter_text = ''
+        self.sort_column = None # None keeps the order of the backend, 0 sorts by label, 1 by IP
+        self.sort_descending = False
+        self.status = None
+
+    def create_frame(self, devices: DeviceRegistry, current_ip: str) -> sg.Frame:
+        '''
+            Builds the network frame for a new window and starts tracking it
+        '''
+        self.current_ip = current_ip
+        self.status = None
+        values, row_colors, count_text = self.get_table_contents(devices)
+
+        network_frame_rows = [
+            [sg.Text('Filter'), sg.Input(self.filter_text, key='-NETWORK_FILTER-', enable_events=True, expand_x=True), sg.Text(count_text, key='-NETWORK_COUNT-')],
+            [sg.Table(values, headings=['Label', 'IP'], key='-NETWORK_TABLE-', col_widths=[30, 15], auto_size_columns=False,
+                      justification='left', num_rows=TABLE_ROWS, row_colors=row_colors, select_mode=sg.TABLE_SELECT_MODE_BROWSE,
+                      enable_events=True, enable_click_events=True, expand_x=True, expand_y=True)],
+        ]
+        return sg.Frame('Network', network_frame_rows, key='-NETWORK_FRAME-', expand_x=True, expand_y=True)
+
+    def get_table_contents(self, devices: DeviceRegistry) -> tuple:
+        '''
+            Filters and sorts devices into the table values, the row colors highlighting our machine and the count text
+        '''
+        filter_text = self.filter_text.strip().casefold()
+        matching = [device for device in devices if filter_text in device.label.casefold() or filter_text in device.ip]
+        if self.sort_column == 0:
+            matching.sort(key=lambda device: device.label.casefold(), reverse=self.sort_descending)
+        elif self.sort_column == 1:
+            matching.sort(key=get_ip_sort_key, reverse=self.sort_descending)
+
+        shown = matching[:MAX_SHOWN_DEVICES]
+        self.shown = [device.label for device in shown]
+        highlight = sg.theme_button_color()
+        own_labels = set(devices.get_labels_by_ip(self.current_ip)) # the devices behind our IP, from the registry index
+        row_colors = [(i, highlight[0], highlight[1]) for i, label in enumerate(self.shown) if label in own_labels]
+
+        if len(devices) == 0:
+            count_text = 'No data'
+        elif len(shown) < len(matching):
+            count_text = f'{len(shown)} of {len(matching)} devices, filter to see the others'
+        elif len(matching) < len(devices):
+            count_text = f'{len(matching)} of {len(devices)} devices'
+        else:
+            count_text = f'{len(devices)} devices'
+        return [[device.label, device.ip] for device in shown], row_colors, count_text
+
+    def render(self, window: sg.Window, devices: DeviceRegistry):
+        values, row_colors, count_text = self.get_table_contents(devices)
+        window['-NETWORK_TABLE-'].update(values=values, row_colors=row_colors)
+        window['-NETWORK_COUNT-'].update(value=count_text)
+
+    def update(self, window: sg.Window, devices: DeviceRegistry, changed_labels: set, current_ip: str):
+        '''
+            Refills the table if any device changed or our IP changed (to move the highlight)
+        '''
+        if len(changed_labels) == 0 and current_ip == self.current_ip:
+            return
+        self.current_ip = current_ip
+        self.render(window, devices)
+
+    def set_filter(self, window: sg.Window, devices: DeviceRegistry, filter_text: str):
+        if filter_text != self.filter_text:
+            self.filter_text = filter_text
+            self.render(window, devices)
+
+    def sort_by(self, window: sg.Window, devices: DeviceRegistry, column: int):
+        '''
+            Sorts by column, or reverses the sorting if it's already sorted by it
+        '''
+        if column == self.sort_column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_column, self.sort_descending = column, False
+        self.render(window, devices)
+
+    def get_label(self, row: int) -> Union[str, None]:
+        return self.shown[row] if 0 <= row < len(self.shown) else None
+
+    def update_status(self, window: sg.Window, status: str):
+        if status != self.status:
+            window['-CURRENT_IP-'].update(value=status)
+            self.status = status
+
+
+
+def get_ip_sort_key(device: Device) -> tuple:
+    # Numeric order for IPs, anything else (e.g. IPs we can't decrypt) goes last
+    try:
+        return (0, int(ipaddress.ip_address(device.ip)), device.label)
+    except ValueError:
+        return (1, 0, device.label)
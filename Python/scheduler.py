@@ -0,0 +1,218 @@
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Union
+
+
+# Netlink groups of the link, address and route changes (linux/rtnetlink.h)
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+NETLINK_ROUTE = 0
+
+UNROUTABLE_ADDRESS = ('192.0.2.1', 53) # TEST-NET-1: connecting a UDP socket to it only picks a route, nothing is sent
+
+
+class NetworkMonitor:
+  """Tells when the local network changed, e.g. a new address, another uplink or default gateway.
+
+  On Linux it listens to netlink address, route and link notifications, which cost nothing until
+  something happens. Elsewhere it polls every poll_interval seconds. Either way the change is only
+  reported if the network fingerprint (the local address used to reach the internet and the
+  default gateway) is different, since netlink also notifies plenty of irrelevant things.
+  """
+
+  def __init__(self, poll_interval: float = 30, settle_time: float = 2, logger=None):
+    self.poll_interval = poll_interval
+    self.settle_time = settle_time # changes come in bursts (link up, address, routes...), wait for the last one
+    self.logger = logger
+    self.netlink = open_netlink_socket()
+    self.fingerprint = get_network_fingerprint()
+
+  def wait(self, timeout: float, wakeup: socket.socket) -> bool:
+    """Blocks for timeout seconds at most. Returns True if the network changed, False on timeout or when woken up."""
+    deadline = time.monotonic() + timeout
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      sockets = [wakeup] if self.netlink is None else [wakeup, self.netlink]
+      readable, _, _ = select.select(sockets, [], [], remaining if self.netlink is not None else min(remaining, self.poll_interval))
+      if wakeup in readable:
+        return False
+      if self.netlink in readable and not self.drain_netlink(deadline, wakeup):
+        return False
+      if self.has_changed():
+        return True
+
+  def drain_netlink(self, deadline: float, wakeup: socket.socket) -> bool:
+    """Reads notifications until they stop for settle_time or the deadline passes. Returns False if woken up meanwhile."""
+    while True:
+      try:
+        self.netlink.recv(65536)
+      except OSError:
+        return True
+      remaining = deadline - time.monotonic()
+      if remaining <= 0: # a host that never stops chattering (containers, router advertisements...) must not block the updates
+        return True
+      readable, _, _ = select.select([wakeup, self.netlink], [], [], min(self.settle_time, remaining))
+      if wakeup in readable:
+        return False
+      if self.netlink not in readable:
+        return True
+
+  def has_changed(self) -> bool:
+    fingerprint = get_network_fingerprint()
+    if fingerprint == self.fingerprint:
+      return False
+    if self.logger is not None:
+      self.logger.log(f'Local network changed: {self.fingerprint} -> {fingerprint}')
+    self.fingerprint = fingerprint
+    return True
+
+
+class UpdateScheduler:
+  """Decides when the next update runs, replacing a fixed interval.
+
+  Updates run right away at startup, when trigger() is called (e.g. "Update now") and when the
+  NetworkMonitor sees the local network change. Otherwise, after an update that changed something
+  (our IP or the network) the next one comes after min_interval, and the interval doubles at every
+  quiet update up to max_interval. Failed updates are retried after retry_interval, doubling up to
+  max_interval. Every delay gets some random jitter, so agents started together drift apart instead
+  of hitting GAS at the same time.
+  """
+
+  def __init__(self, min_interval: float, max_interval: float, retry_interval: float = 15, jitter: float = 0.1,
+               monitor: Union[NetworkMonitor, None] = None, logger=None):
+    self.min_interval = min_interval # seconds
+    self.max_interval = max_interval
+    self.retry_interval = retry_interval
+    self.jitter = jitter
+    self.monitor = monitor
+    self.logger = logger
+    self.interval = min_interval
+    self.consecutive_failures = 0
+    self.next_run = time.monotonic() # time.monotonic() of the next update
+    self.triggered = False
+    self.stopped = False
+    self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+
+  def record_result(self, success: bool, changed: bool) -> float:
+    """Schedules the next update after one that (didn't) succeed and (didn't) change anything, returns its delay."""
+    if not success:
+      self.consecutive_failures += 1
+      delay = min(self.retry_interval * 2 ** (self.consecutive_failures - 1), self.max_interval)
+    else:
+      self.consecutive_failures = 0
+      self.interval = self.min_interval if changed else min(self.interval * 2, self.max_interval)
+      delay = self.interval
+    delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+    self.next_run = time.monotonic() + delay
+    return delay
+
+  def get_time_to_next_run(self) -> float:
+    return max(0, self.next_run - time.monotonic())
+
+  def trigger(self):
+    self.triggered = True
+    self.wake_up()
+
+  def stop(self):
+    self.stopped = True
+    self.wake_up()
+
+  def wake_up(self):
+    try:
+      self.wakeup_writer.send(b'\0')
+    except OSError:
+      pass
+
+  def wait(self) -> Union[str, None]:
+    """Blocks until the next update is due. Returns why ("timer", "trigger" or "network"), or None once stopped."""
+    while True:
+      if self.stopped:
+        return None
+      if self.triggered:
+        self.triggered = False
+        return 'trigger'
+      remaining = self.next_run - time.monotonic()
+      if remaining <= 0:
+        return 'timer'
+
+      if self.monitor is not None:
+        changed = self.monitor.wait(remaining, self.wakeup_reader)
+      else:
+        changed = False
+        select.select([self.wakeup_reader], [], [], remaining)
+      self.drain_wakeups()
+      if changed:
+        return 'network'
+
+  def drain_wakeups(self):
+    while select.select([self.wakeup_reader], [], [], 0)[0]:
+      self.wakeup_reader.recv(64)
+
+  def run(self, update: Callable[[], tuple], on_scheduled: Union[Callable[[], None], None] = None):
+    """Runs update() whenever it's due, until stop(). update() returns (success, changed)."""
+    while True:
+      reason = self.wait()
+      if reason is None:
+        return
+      self.log(f'Running update ({reason})')
+      try:
+        success, changed = update()
+      except Exception as e:
+        self.log(f'ERROR: update failed: {e}')
+        success, changed = False, False
+      # After a local network change the public IP can take a little while to follow, so check again soon
+      delay = self.record_result(success, changed or reason == 'network')
+      self.log(f'Next update in {int(delay)} seconds')
+      if on_scheduled is not None:
+        on_scheduled()
+
+  def start(self, update: Callable[[], tuple], on_scheduled: Union[Callable[[], None], None] = None) -> threading.Thread:
+    thread = threading.Thread(target=self.run, args=(update, on_scheduled), name='UpdateScheduler', daemon=True)
+    thread.start()
+    return thread
+
+  def log(self, *args):
+    if self.logger is not None:
+      self.logger.log(*args)
+
+
+
+def open_netlink_socket() -> Union[socket.socket, None]:
+  """A socket receiving the netlink link, address and route notifications, None if not on Linux."""
+  try:
+    netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    netlink.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR))
+    return netlink
+  except (AttributeError, OSError): # no AF_NETLINK outside of Linux
+    return None
+
+def get_network_fingerprint() -> tuple:
+  return (get_local_address(), get_default_gateway())
+
+def get_local_address() -> Union[str, None]:
+  try:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+      sock.connect(UNROUTABLE_ADDRESS)
+      return sock.getsockname()[0]
+  except OSError: # no route to the internet
+    return None
+
+def get_default_gateway() -> Union[str, None]:
+  # Linux only, elsewhere the local address alone has to do
+  try:
+    with open('/proc/net/route', 'r') as file:
+      for line in file.readlines()[1:]:
+        fields = line.split()
+        if fields[1] == '00000000' and int(fields[3], 16) & 0x2: # default route through a gateway (RTF_GATEWAY)
+          return socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
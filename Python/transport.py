@@ -0,0 +1,158 @@
+import random
+import threading
+import time
+from typing import Union
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# (connect, read) timeouts in seconds, used when a request doesn't specify its own
+DEFAULT_TIMEOUT = (5, 30)
+# Shown by GAS when doPost() returns nothing, i.e. older deployments getting a requestType they don't know
+NO_RETURN_MESSAGE = 'The script completed but did not return anything'
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+  """Raised instead of sending a request while the circuit for its host is open."""
+
+
+class CircuitBreaker:
+  """Stops requests to a host after too many consecutive failures.
+
+  After `failure_threshold` failed requests the circuit opens and every call is
+  refused for `reset_timeout` seconds. After that a single trial request is let
+  through (half-open): its success closes the circuit, its failure opens it again.
+  """
+
+  def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.failures = 0
+    self.opened_at = None
+    self._lock = threading.Lock()
+
+  def allow_request(self) -> bool:
+    with self._lock:
+      if self.opened_at is None:
+        return True
+      if time.monotonic() - self.opened_at >= self.reset_timeout:
+        # Half-open: let one trial through and keep refusing the others until it reports back
+        self.opened_at = time.monotonic()
+        return True
+      return False
+
+  def record_success(self):
+    with self._lock:
+      self.failures = 0
+      self.opened_at = None
+
+  def record_failure(self):
+    with self._lock:
+      self.failures += 1
+      if self.failures >= self.failure_threshold:
+        self.opened_at = time.monotonic()
+
+  def is_open(self) -> bool:
+    return self.opened_at is not None
+
+
+class Transport:
+  """Shared HTTP layer for IPManager.
+
+  Keeps connections alive through a pooled requests.Session, bounds every request
+  with a (connect, read) timeout, retries connection errors, 5xx responses and the
+  GAS html error pages (except the "did not return anything" one, retrying it can't help)
+  with exponential backoff and jitter, and keeps a circuit
+  breaker for every host so that a dead backend isn't hammered.
+  """
+
+  def __init__(self, logger=None, max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8,
+               pool_size: int = 4, failure_threshold: int = 5, reset_timeout: float = 60):
+    self.logger = logger
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.breakers = {}
+    self._lock = threading.Lock()
+
+    self.session = requests.Session()
+    # Retries are handled here rather than by urllib3, so that html error pages and the breaker are accounted for
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+
+  def get(self, url: str, timeout: Union[float, tuple] = DEFAULT_TIMEOUT, **kwargs) -> requests.Response:
+    return self.request('GET', url, timeout=timeout, **kwargs)
+
+  def post(self, url: str, timeout: Union[float, tuple] = DEFAULT_TIMEOUT, **kwargs) -> requests.Response:
+    return self.request('POST', url, timeout=timeout, **kwargs)
+
+  def request(self, method: str, url: str, timeout: Union[float, tuple] = DEFAULT_TIMEOUT, retries: int = None,
+              **kwargs) -> requests.Response:
+    """Sends a request, retrying it on transient failures.
+
+    Args:
+      retries (int, optional): overrides max_retries for this request
+
+    Returns:
+      requests.Response: the first good response, or the last bad one (5xx or html page) once retries are exhausted
+
+    Raises:
+      CircuitOpenError: if the breaker for the url's host is open
+      requests.exceptions.RequestException: if the request still fails to complete after every retry
+    """
+    breaker = self.get_breaker(url)
+    if not breaker.allow_request():
+      raise CircuitOpenError(f'Circuit open for {urlparse(url).netloc}, request not sent')
+
+    max_retries = self.max_retries if retries is None else retries
+    for attempt in range(max_retries + 1):
+      try:
+        response = self.session.request(method, url, timeout=timeout, **kwargs)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        if attempt == max_retries:
+          breaker.record_failure()
+          raise
+        self.log(f'{method} {url} failed ({e}), retrying...')
+      else:
+        if not is_retryable_response(response):
+          breaker.record_success()
+          return response
+        if attempt == max_retries:
+          breaker.record_failure()
+          return response
+        self.log(f'{method} {url} returned a bad response ({response.status_code}), retrying...')
+      time.sleep(self.get_backoff(attempt))
+
+  def get_backoff(self, attempt: int) -> float:
+    # "Full jitter": a random wait between 0 and the capped exponential delay
+    return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+  def get_breaker(self, url: str) -> CircuitBreaker:
+    host = urlparse(url).netloc
+    with self._lock:
+      if host not in self.breakers:
+        self.breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+      return self.breakers[host]
+
+  def log(self, *args):
+    if self.logger is not None:
+      self.logger.log(*args)
+
+  def close(self):
+    self.session.close()
+
+
+
+def is_html_error_page(response: requests.Response) -> bool:
+  return '<!DOCTYPE html>' in response.text
+
+def is_no_return_page(response: requests.Response) -> bool:
+  return NO_RETURN_MESSAGE in response.text
+
+def is_retryable_response(response: requests.Response) -> bool:
+  return response.status_code >= 500 or (is_html_error_page(response) and not is_no_return_page(response))
@@ -0,0 +1,54 @@
+import asyncio
+from concurrent.futures import Future
+import threading
+from typing import Callable, Union
+
+
+
+class UpdateEngine:
+  """Runs IPManager updates on an asyncio loop living in its own thread.
+
+  Callers (the GUI event loop, the scheduler) never block: request_update() returns right away
+  and on_update_done is called from the engine thread once the update has finished, so it must
+  only do thread-safe things like window.write_event_value().
+  Only one update is ever in flight: requests made while one is running get the same future.
+  """
+
+  def __init__(self, logger=None, on_update_done: Union[Callable[[], None], None] = None):
+    self.logger = logger
+    self.on_update_done = on_update_done
+    self.current_update = None
+    self._lock = threading.Lock()
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.loop.run_forever, name='UpdateEngine', daemon=True)
+    self.thread.start()
+
+  def request_update(self, ip_manager) -> Future:
+    with self._lock:
+      if self.is_updating():
+        self.log('Update already in progress')
+        return self.current_update
+      self.current_update = asyncio.run_coroutine_threadsafe(self.run_update(ip_manager), self.loop)
+      return self.current_update
+
+  def is_updating(self) -> bool:
+    return self.current_update is not None and not self.current_update.done()
+
+  async def run_update(self, ip_manager) -> bool:
+    """Returns whether the update succeeded, the result of the future given by request_update()."""
+    try:
+      return await ip_manager.async_update()
+    except Exception as e:
+      self.log(f'ERROR: update failed: {e}')
+      return False
+    finally:
+      if self.on_update_done is not None:
+        self.on_update_done()
+
+  def log(self, *args):
+    if self.logger is not None:
+      self.logger.log(*args)
+
+  def stop(self):
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()